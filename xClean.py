@@ -1,7 +1,15 @@
 from vapoursynth import core
 import vapoursynth as vs
 import math
-from typing import Optional
+import functools
+import threading
+import time
+import os
+import ctypes
+import hashlib
+import pickle
+import zlib
+from typing import Optional, NamedTuple
 import nnedi3_resample as nnedi3
 
 """
@@ -31,6 +39,7 @@ BM3D performance can be greatly improved by setting radius=0, block_step=7, bm_r
 For 720p WebCam, optimal settings are: sharp=9.5, m1=.65, h=2.8
 For 288p anime, optimal settings are: sharp=9.5, m1=.7, rn=0, optional depth=1
 For 4-5K GoPro (with in-camera sharpening at Low), optimal settings are: sharp=7.7, m1=.5, m2=3.7, optional strength=-50 (or m1=.6, m2=3.8 if your computer can handle it)
+To pick performance settings automatically, use xCleanAuto(clip, target_fps=..., max_memory=...)
 
 
 +++ Description +++
@@ -87,8 +96,10 @@ MVTools (m1) and BM3D (m2) passes can also be downscaled for performance gain, a
 Optional resize factor is set after the dot:
 m1 = .6 or 1.6 processes MVTools in 8-bit at 60% of the size. m2 = 3.6 processes BM3D in 16-bit at 60% of the size.
 You may want to downscale MVTools (m1) because of high CPU usage and low impact on outcome.
-You may want to downscale BM3D (m2) because of high memory usage. If you run out of memory, lower the size until you get no hard-drive paging.
+You may want to downscale BM3D (m2) because of high memory usage. If you run out of memory, lower the size until you get no hard-drive paging,
+or let xCleanBudget pick it from a memory budget (see Memory Budget below).
 Note: Setting radius=0 greatly reduces BM3D memory usage!
+To keep full resolution within a memory budget, use xCleanTiled instead of downscaling (see Tiled Processing below).
 
 
 +++ Renoise and Sharpen  (rn=14, sharp=9.5) +++
@@ -134,9 +145,54 @@ none = don't touch chroma
 bicubic = bicubic(0, .5) upsampling
 nnedi3 = NNEDI3 upsampling
 reconstructor = feisty2's ChromaReconstructor_faster v3.0 HBD mod
+native = keep chroma at source subsampling through all passes, skipping 4:4:4 upsampling. Processing is done in YUV (conv is ignored for subsampled sources).
 
 downchroma: whether to downscale back to match source clip. Default is False for reconstructor and True for other methods.
 
++++ Auto-tuning  (xCleanAuto) +++
+xCleanAuto(clip, target_fps, max_memory, samples=4, **kwargs) times a few frames of each configuration in AUTO_LADDER, ordered from highest quality
+to fastest, and returns the first one that renders at least target_fps and whose estimated memory usage (in MB) fits within max_memory.
+It searches m1/m2 resize factors, block_step/bm_range/ps_range, radius and d. Other kwargs are passed to xClean, and searched settings
+passed explicitly are kept fixed. If no configuration fits, the fastest one is used. Chosen settings are set as xClean_<name> frame props,
+along with the measured xClean_fps.
+
++++ Tiled Processing  (xCleanTiled) +++
+xCleanTiled(clip, max_memory=None, tiles=None, overlap=None, **kwargs) splits each frame into a grid of overlapping tiles and runs xClean on each tile,
+so that 5K/8K material can run all passes at full resolution. The grid is the smallest one whose estimated memory usage (in MB) fits within
+max_memory, or tiles=(columns, rows). The estimate covers every thread working on a tile, and the framebuffer cache holding the temporal
+window of every tile. Each tile is denoised with overlap pixels of context on each side, enough for MVTools blocks and
+BM3D/KNLMeans search ranges by default. Half of the context is discarded and the other half is feather-blended with the neighbouring tile.
+Auto settings (block size, sharpening) are based on the full frame resolution so that tiles match.
+Per-frame decisions (scenecut, bypass, bypassbm3d, mvadapt) would be made on each tile's crop and differ across seams, so they aren't supported.
+
++++ Memory Budget  (xCleanBudget) +++
+xCleanBudget(clip, max_memory, threads=None, min_threads=None, **kwargs) keeps the whole process within max_memory (in MB). Peak memory is
+estimated from the frames each pass holds for every thread (at its size and bit depth, with the MVTools Degrain window, BM3D radius and KNLMeans d),
+plus a framebuffer cache large enough to hold the temporal window of every thread. The given m1, m2 and radius are the starting point: threads
+are lowered down to min_threads (half of core.num_threads by default) first, then BM3D radius, then the m2 and m1 resize factors (see
+BUDGET_SCALES) until the estimate fits. core.num_threads and core.max_cache_size are set accordingly, the cache gets all the memory left.
+The chosen settings are set as xClean_<name> frame props, along with xClean_threads and xClean_cache (MB). If nothing fits, use xCleanTiled.
+
++++ Noise Bypass  (bypass=0, bypassbm3d=0) +++
+Clean frames don't need every pass. When set, the noise of each frame is estimated from its luma (Immerkaer's Laplacian method, as a
+standard deviation in 8-bit units, averaged over 5 frames) and drives a per-frame switch. Frames whose noise is below bypassbm3d skip
+the BM3D pass, and frames below bypass skip the whole chain and pass through the source converted to the output format.
+The chosen path is set as the xClean_bypass frame prop (0 = all passes, 1 = without BM3D, 2 = passthrough) along with xClean_noise.
+Values between 1 and 2 are a good start for mostly clean footage; check xClean_noise on your clips.
+
++++ Scene Changes  (scenecut=0) +++
+Temporal filters blend frames across scene cuts, which only produces ghosting. When scenecut is set, cuts are detected from the luma difference
+between consecutive frames (average absolute difference between 0 and 1 on a 1/4 size copy, .1 is a good start) and set as _SceneChangePrev
+and _SceneChangeNext frame props. The first and last frames count as cuts. Near a cut, MVTools Degrain, BM3D radius, KNLMeans d and the
+post-processing temporal medians shrink their window so that it doesn't cross the cut. xClean_render also splits chunks at cuts, without padding.
+
++++ Live Capture  (causal=False) +++
+Every temporal filter reads frames on both sides, so a live source (eg: a webcam) would have to be delayed by several frames. With causal=True,
+frame n only reads frames up to n and can be output as soon as it's captured. MVTools averages each frame with its previous frames motion-compensated
+by the forward vectors (the backward vectors look ahead and aren't analysed), with blocks whose SAD is above thsad left out. KNLMeans runs on each frame
+surrounded by its previous d frames on both sides (mirrored), the post-processing temporal medians take the previous 2 frames, and BM3D radius is 0.
+Noise bypass, mvadapt and scene cut detection only read previous frames. Use xClean_bench.py --preset webcam to check real time throughput.
+
 +++ Anime +++
 For anime, set rn=0. Optionally, you can set depth to 1 or 2 to thicken the lines.
 
@@ -155,15 +211,39 @@ a = 2: KNLMeans spacial radius.
 sigma = 9: BM3D strength.
 bm3d_fast = False. BM3D fast.
 conv = True. Whether to convert to OPP format for BM3D and YCgCoR for everything else. If false, it will process in standard YUV444.
+fused = False. Runs post-processing as a few fused akarin.Expr kernels instead of a long chain of filters. Output is within 1 LSB, except on frame borders.
+ppfinal = False. Only the last pass runs full post-processing. Earlier passes skip renoise and sharpening, and share a detail mask derived from the source luma.
+lowpp = False. When BM3D is downscaled (m2 with resize factor), runs its post-processing at the reduced resolution before upscaling, like the MVTools pass.
+defh = None. Resolution used for auto settings (MVTools block size, sharpening), derived from the clip size by default.
+shared = None. Dict in which nodes are shared between xClean calls on the same clip. A stage is reused when all settings upstream of it are the same,
+eg: calls that only differ by h share the MVTools and BM3D passes. Used by xClean_sweep.
+passcache = None. Directory where the MVTools and BM3D pass outputs are stored, in their processing format and bit depth, and read back on later renders
+when the pass input and every setting upstream of the pass output are the same. Tuning KNLMeans (h, d, a) or the last pass post-processing then doesn't run
+MVTools and BM3D again for frames already rendered. Settings that change a pass output (eg: sharp changes the BM3D ref) start a new store.
+mvcache = None. Directory where MVTools vectors are stored and read back on later renders of the same source with the same m1 and analysis settings.
+Only the frames already rendered are read back, so it's useful when tuning settings after pass 1 (sharp, rn, h, strength, m2, m3).
+With both stores, each frame is only read back if the source frames it was rendered from (its temporal window) are unchanged, edited frames render again.
+mvadapt = False. Picks the MVTools Degrain radius per frame from the motion and SAD of the delta 1 vectors (averaged over 5 frames): radius 1 on fast motion
+(above MV_FAST_MOTION pixels per frame) or clean frames (SAD below MV_CLEAN_SAD per 8x8 block), radius 2 in between, and the full radius elsewhere.
+Longer deltas are only analysed for frames that use them. The choice is set as the xClean_mvradius frame prop, with xClean_motion and xClean_sad.
+mcomp = False. Feeds KNLMeans (d) with neighbour frames motion-compensated by the MVTools pass vectors instead of raw neighbours, so that it can
+run with a smaller d. Requires m1 > 0. When m1 is downscaled, neighbours are compensated at m1 size. d is limited to 3 (4 with m1=3).
+BM3D keeps raw neighbours: its aggregation needs every frame of a compensated window denoised, which costs 2 * radius + 1 times more per frame.
+scenecut = 0. Scene cut detection threshold, see Scene Changes.
+causal = False. Only reads past frames, for live sources, see Live Capture.
+bypass = 0, bypassbm3d = 0. Noise levels below which a frame passes through or skips BM3D, see Noise Bypass.
+profile = None. Pass a Profiler() instance to record per-frame wall time of each stage, as xClean_<stage>_ms frame props and in profile.Report().
+lowmask = False. With strength <= 0, computes the Dynamic Denoiser Strength mask once on the downscaled m1/m2 clip and resamples it for the other passes.
 """
 
 def xClean(clip: vs.VideoNode, chroma: str = "nnedi3", sharp: float = 9.5, rn: float = 14, deband: bool = False, depth: int = 0, strength: int = 20, m1: float = .6, m2: int = 2, m3: int = 2, outbits: Optional[int] = None,
         dmode: int = 0, rgmode: int = 18, thsad: int = 400, d: int = 2, a: int = 2, h: float = 1.4, gpuid: int = 0, gpucuda: Optional[int] = None, sigma: float = 9, 
-        block_step: int = 4, bm_range: int = 16, ps_range: int = 8, radius: int = 0, bm3d_fast: bool = False, conv: bool = True, downchroma: bool = None) -> vs.VideoNode:
+        block_step: int = 4, bm_range: int = 16, ps_range: int = 8, radius: int = 0, bm3d_fast: bool = False, conv: bool = True, downchroma: bool = None, lowmask: bool = False, fused: bool = False, ppfinal: bool = False, lowpp: bool = False, profile = None, defh: Optional[int] = None, bypass: float = 0, bypassbm3d: float = 0, scenecut: float = 0, mvcache: Optional[str] = None, mcomp: bool = False, mvadapt: bool = False, passcache: Optional[str] = None, shared: Optional[dict] = None, causal: bool = False) -> vs.VideoNode:
+    params = dict(locals()) # Settings for the noise gate variants
 
     width = clip.width
     height = clip.height
-    defH = max(height, width // 4 * 3) # Resolution calculation for auto blksize settings
+    defH = defh or max(height, width // 4 * 3) # Resolution calculation for auto blksize settings
     if sharp < 0 or sharp > 20:
         raise ValueError("xClean: sharp must be between 0 and 20")
     if rn < 0 or rn > 20:
@@ -180,8 +260,23 @@ def xClean(clip: vs.VideoNode, chroma: str = "nnedi3", sharp: float = 9.5, rn: f
         raise ValueError("xClean: m3 (KNLMeansCL pass) can be 0 (disabled), 1 (8-bit), 2 (16-bit), 3 (32-bit)")
     if m1 == 0 and m2 == 0 and m3 == 0:
         raise ValueError("xClean: At least one pass must be enabled")
-    if not chroma in ["none", "bicubic", "nnedi3", "reconstructor"]:
-        raise ValueError("xClean: chroma must be none, bicubic, nnedi3 or reconstructor")
+    if not chroma in ["none", "bicubic", "nnedi3", "reconstructor", "native"]:
+        raise ValueError("xClean: chroma must be none, bicubic, nnedi3, reconstructor or native")
+    if mcomp and m1 == 0:
+        raise ValueError("xClean: mcomp requires the MVTools pass (m1 > 0)")
+    if scenecut < 0 or scenecut > 1:
+        raise ValueError("xClean: scenecut must be between 0 and 1")
+    if bypass < 0 or bypassbm3d < 0 or 0 < bypassbm3d < bypass:
+        raise ValueError("xClean: bypass and bypassbm3d must be positive, and bypass can't be higher than bypassbm3d")
+
+    # Per-frame switch between all passes, no BM3D and passthrough
+    if bypass > 0 or bypassbm3d > 0 and m2 > 0:
+        if not m1 and not m3:
+            bypass, bypassbm3d = max(bypass, bypassbm3d), 0 # BM3D is the only pass
+        # Variants share their common stages (pass 1 without BM3D) through one shared dict
+        gate = params["shared"] if params["shared"] is not None else {}
+        build = lambda **kw: xClean(**dict(params, bypass=0, bypassbm3d=0, shared=gate, **kw))
+        return NoiseGate(clip, build, bypass, bypassbm3d if m2 > 0 else 0, causal)
 
     uv = clip
     if chroma == "none":
@@ -192,40 +287,101 @@ def xClean(clip: vs.VideoNode, chroma: str = "nnedi3", sharp: float = 9.5, rn: f
     if isGray:
         chroma = "none"
         conv = False
+    if chroma == "native" and samp in ["420", "422"]:
+        conv = False # YCgCoR and OPP require 4:4:4
     dochroma = chroma != "none" or samp == "RGB"
-    downchroma = downchroma or False if chroma == "reconstructor" else True
+    downchroma = downchroma or False if chroma == "reconstructor" else chroma != "native"
 
     gpucuda = gpucuda if gpucuda != None else gpuid
     bd = clip.format.bits_per_sample
-    fulls = GetColorRange(clip) == 0
-    matrix = GetMatrix(clip)
+    info = GetClipInfo(clip) # Only place where a frame is rendered during script construction
+    fulls = info.fulls
+    matrix = info.matrix
     outbits = outbits or bd
     if not outbits in [8, 9, 10, 12, 14, 16, 32]:
         raise ValueError("xClean: outbits must be 8, 9, 10, 12, 14, 16 or 32")
-    cplace = ["left", "center", "top_left", "left", "left", "left"] [GetChromaLoc(clip)]
-
-    # Reference clips are in RGB or GRAY format, to allow converting to desired formats
-    cconv = ConvertBits(clip, 16, fulls, True) if bd < 16 else clip
-    cconv = cconv if samp in ["444", "RGB", "GRAY"] else \
-        ChromaReconstructor(cconv, gpuid) if chroma == "reconstructor" else \
-        nnedi3.nnedi3_resample(cconv, csp=vs.YUV444P16 if bd < 32 else vs.YUV444PS, mode="nnedi3cl" if gpuid >= 0 else "znedi3", device=max(0, gpuid), fulls=fulls, fulld=fulls) if chroma == "nnedi3" else \
-        core.fmtc.resample(cconv, csp=vs.YUV444P16 if bd < 32 else vs.YUV444PS, kernel="bicubic", a1=0, a2=.5, fulls=fulls, fulld=fulls, cplace=cplace)
-    cconv = ConvertMatrix(cconv, vs.RGB, fulls) if conv and clip.format.color_family == vs.YUV else cconv
-    c32 = ConvertBits(cconv, 32, fulls, False)
-    c16 = ConvertBits(cconv, 16, fulls, True)
-    c8 = ConvertBits(cconv, 8, fulls, True)
+    cplace = ["left", "center", "top_left", "left", "left", "left"] [info.chromaloc]
+
+    # Wraps a stage with the profiler when profiling is enabled. reach is the number of input frames read on each side (only before with causal).
+    def Stage(name: str, build, *inputs, reach: int = 0) -> vs.VideoNode:
+        return profile.Wrap(name, build, *inputs, before=reach, after=0 if causal else reach) if profile else build(*inputs)
+
+    # Stage outputs in the shared dict are keyed by the settings of the stage and of every stage before it.
+    # Settings read by every stage (scenes) are part of the first key. The source clip is kept in the dict,
+    # so that its id isn't reused by another clip while the dict holds nodes built from it.
+    upstream = (id(params["clip"]),)
+    if shared is not None:
+        shared.setdefault(("clip", id(params["clip"])), params["clip"])
+    def Shared(name: str, build, *settings):
+        nonlocal upstream
+        upstream += ((name,) + settings,)
+        if shared is None:
+            return build()
+        if upstream not in shared:
+            shared[upstream] = build()
+        return shared[upstream]
+
+    # Reference clips are in YUV444, RGB or GRAY format, each pass converts to its colorspace in a single matrix pass
+    def Upsample() -> vs.VideoNode:
+        cconv = ConvertBits(clip, 16, fulls, True) if bd < 16 else clip
+        return cconv if samp in ["444", "RGB", "GRAY"] or chroma == "native" else Stage("chroma", lambda cconv: \
+            ChromaReconstructor(cconv, gpuid, fulls) if chroma == "reconstructor" else \
+            nnedi3.nnedi3_resample(cconv, csp=vs.YUV444P16 if bd < 32 else vs.YUV444PS, mode="nnedi3cl" if gpuid >= 0 else "znedi3", device=max(0, gpuid), fulls=fulls, fulld=fulls) if chroma == "nnedi3" else \
+            core.fmtc.resample(cconv, csp=vs.YUV444P16 if bd < 32 else vs.YUV444PS, kernel="bicubic", a1=0, a2=.5, fulls=fulls, fulld=fulls, cplace=cplace), cconv)
+    csp = "RGB" if samp == "RGB" else "YUV"
+    planner = Shared("source", lambda: ConvPlanner(Upsample(), csp, fulls, matrix, profile), chroma, conv, gpuid, causal, scenecut)
+    scenes = planner.Memo(("scenes", scenecut, causal), lambda: SceneChanges(clip, scenecut, causal)) if scenecut > 0 else None
+    ycgco = "YCgCoR" if conv else None
+    radius = 0 if causal else radius # BM3D aggregates blocks from following frames
     output = None
+    vectors = None
+
+    # Dynamic Denoiser Strength mask, built once per resolution and bit depth and shared by all passes.
+    # The planner can be shared between xClean calls, so memo keys hold every setting the mask depends on.
+    mr = min([r % 1 for r in [m1, m2] if r % 1 > 0] or [1])
+    masksrc = planner.Get(16, ycgco, mr, kernel="bicubic", a1=0, a2=.75) if lowmask and mr < 1 else None
+    def GetStrengthMask(c: vs.VideoNode) -> Optional[vs.VideoNode]:
+        if strength > 0:
+            return None
+        bits = max(16, c.format.bits_per_sample)
+        if masksrc and c.width > masksrc.width:
+            return planner.Memo(("smask", c.width, c.height, bits, strength, defH, lowmask, mr),
+                lambda: GetStrengthMask(ConvertBits(masksrc, bits, fulls, False)).resize.Bilinear(c.width, c.height))
+        return planner.Memo(("smask", c.width, c.height, bits, strength, defH, lowmask, mr),
+            lambda: StrengthMask(core.std.ShufflePlanes(ConvertBits(c, bits, fulls, False), [0], vs.GRAY), defH, strength, fulls))
+
+    # Pass output store, keyed by the pass input and all settings upstream of the output, chained from pass to pass
+    passkey = ""
+    def PassCheckpoint(name: str, output: vs.VideoNode, c: vs.VideoNode, reach: int, *settings) -> vs.VideoNode:
+        nonlocal passkey
+        if not passcache:
+            return output
+        passkey = Fingerprint(c, passkey, *settings)
+        return Checkpoint(output, os.path.join(passcache, f"{name}-{passkey}"), WindowHash(c, reach))
+
+    # With ppfinal, passes before the last one run light post-processing with a detail mask shared per resolution
+    last = 3 if m3 > 0 else 2 if m2 > 0 else 1
+    pp = (defH, sharp, rn, rgmode, strength, fused, ppfinal, last, lowmask, mr)
+    ppreach = 2 if rgmode > 0 else 0 # Two chained temporal medians
+    def GetDetailMask(c: vs.VideoNode, method: int) -> Optional[vs.VideoNode]:
+        if not ppfinal or method + 1 == last or rgmode == 0:
+            return None
+        bits = max(16, c.format.bits_per_sample)
+        return planner.Memo(("dmask", c.width, c.height, bits, rgmode),
+            lambda: DetailMask(core.std.ShufflePlanes(ConvertBits(c, bits, fulls, False), [0], vs.GRAY), rgmode))
 
     # Apply MVTools
     if m1 > 0:
         m1r = 1 if m1 == int(m1) else m1 % 1 # Decimal point is resize factor
         m1 = int(m1)
-        c1 = c32 if m1 == 3 else c16 if m1 == 2 else c8
-        c1 = c1.fmtc.resample((width * m1r)//4*4, (height * m1r)//4*4, kernel="bicubic", a1=0, a2=.75) if m1r < 1 else c1
-        c1 = RGB_to_YCgCoR(c1, fulls) if conv else c1
-        output = MvTools(c1, defH, thsad)
+        c1 = planner.Get(32 if m1 == 3 else 16 if m1 == 2 else 8, ycgco, m1r, kernel="bicubic", a1=0, a2=.75)
+        vectors = planner.Memo(("vectors", m1, m1r, defH, mvcache), lambda: AnalyseVectors(c1, defH, mvcache, causal)) if mcomp else None
+        mvreach = TemporalReach(m1, 0, 0, rgmode=0, mvadapt=mvadapt, causal=causal)
+        output = Shared("MvTools", lambda: Stage("MvTools", lambda c1: MvTools(c1, defH, thsad, info, scenes, mvcache, vectors, mvadapt, causal), c1, reach=mvreach),
+            m1, m1r, defH, thsad, scenecut, mvadapt, mcomp, mvcache)
+        output = PassCheckpoint("mvtools", output, c1, mvreach, defH, thsad, scenecut, mvadapt, causal)
         sharp1 = max(0, min(20, sharp + (1 - m1r) * .35))
-        output = PostProcessing(output, c1, defH, strength, sharp1, rn, rgmode, 0)
+        output = Shared("PostProcessing1", lambda: Stage("PostProcessing1", lambda output, c1: PostProcessing(output, c1, defH, strength, sharp1, rn, rgmode, 0, info, GetStrengthMask(c1), fused, GetDetailMask(c1, 0), scenes, causal), output, c1, reach=ppreach), *pp)
         # output in YCgCoR format
 
     # Apply BM3D
@@ -233,20 +389,28 @@ def xClean(clip: vs.VideoNode, chroma: str = "nnedi3", sharp: float = 9.5, rn: f
         m2r = 1 if m2 == int(m2) else m2 % 1 # Decimal point is resize factor
         m2 = int(m2)
         m2o = max(2, max(m2, m3))
-        c2 = c32 if m2o==3 else c16
-        ref = RGB_to_OPP(YCgCoR_to_RGB(output, fulls), fulls) if output and conv else output if output else None
-        ref = ref.fmtc.resample((width * m2r)//4*4, (height * m2r)//4*4, csp = vs.GRAYS if isGray else vs.YUV444PS, kernel = "spline36") if ref else None
-        c2r = c2.fmtc.resample((width * m2r)//4*4, (height * m2r)//4*4, kernel = "bicubic", a1=0, a2=0.5) if m2r < 1 else c2
-        c2r = ConvertBits(RGB_to_OPP(c2r, fulls) if conv else c2r, 32, fulls, False)
-
-        output = BM3D(c2r, ref, sigma, gpucuda, block_step, bm_range, ps_range, radius, bm3d_fast)
+        c2 = planner.Get(32 if m2o==3 else 16, ycgco)
+        ref = ConvertColorspace(output, "YCgCoR", "OPP", fulls) if output and conv else output if output else None
+        ref = ref.fmtc.resample((width * m2r)//4*4, (height * m2r)//4*4, csp = GetFormat(ref.format.color_family, 32, ref.format.subsampling_w, ref.format.subsampling_h), kernel = "spline36") if ref else None
+        c2r = planner.Get(c2.format.bits_per_sample, "OPP" if conv else None, m2r, kernel = "bicubic", a1=0, a2=0.5)
+        c2r = ConvertBits(c2r, 32, fulls, False)
+
+        output = Shared("BM3D", lambda: Stage("BM3D", lambda c2r, ref: BM3D(c2r, ref, sigma, gpucuda, block_step, bm_range, ps_range, radius, bm3d_fast, scenes), c2r, ref, reach=radius * 2),
+            m2, m2r, m2o, sigma, gpucuda, block_step, bm_range, ps_range, radius, bm3d_fast)
+        # The BM3D ref is the pass 1 output after post-processing
+        output = PassCheckpoint("bm3d", output, c2r, TemporalReach(params["m1"], m2, 0, radius, rgmode=rgmode, mvadapt=mvadapt, causal=causal), sharp, rn, rgmode, strength, fused, ppfinal, lowmask, last,
+            sigma, gpucuda >= 0, block_step, bm_range, ps_range, radius, bm3d_fast, scenecut, causal)
         
         output = ConvertBits(output, c2.format.bits_per_sample, fulls, False)
-        output = RGB_to_YCgCoR(OPP_to_RGB(output, fulls), fulls) if conv else output
-        c2 = RGB_to_YCgCoR(c2, fulls) if conv else c2
-        output = output.fmtc.resample(width, height, kernel = "spline36") if m2r < 1 else output
+        output = ConvertColorspace(output, "OPP", "YCgCoR", fulls) if conv else output
+        if m2r < 1 and lowpp:
+            # Post-process at reduced size, the result gets upscaled once before KNLMeans
+            c2 = planner.Get(c2.format.bits_per_sample, ycgco, m2r, kernel = "bicubic", a1=0, a2=0.5)
+        else:
+            output = output.fmtc.resample(width, height, kernel = "spline36") if m2r < 1 else output
         sharp2 = max(0, min(20, sharp + (1 - m2r) * .95))
-        output = PostProcessing(output, c2, defH, strength, sharp2, rn, rgmode, 1)
+        output = Shared("PostProcessing2", lambda: Stage("PostProcessing2", lambda output, c2: PostProcessing(output, c2, defH, strength, sharp2, rn, rgmode, 1, info, GetStrengthMask(c2), fused, GetDetailMask(c2, 1), scenes, causal), output, c2, reach=ppreach),
+            lowpp, *pp)
         # output in YCgCoR format
 
     if output and output.height < height:
@@ -255,48 +419,458 @@ def xClean(clip: vs.VideoNode, chroma: str = "nnedi3", sharp: float = 9.5, rn: f
     # Apply KNLMeans
     if m3 > 0:
         m3 = min(2, m3) # KNL internally computes in 16-bit
-        c3 = c32 if m3==3 else c16
-        c3 = RGB_to_YCgCoR(c3, fulls) if conv else c3
+        c3 = planner.Get(32 if m3==3 else 16, ycgco)
         ref = ConvertBits(output, c3.format.bits_per_sample, fulls, False) if output else None
-        output = KnlMeans(c3, ref, d, a, h, gpuid)
+        output = Shared("KnlMeans", lambda: Stage("KnlMeans", lambda c3, ref: KnlMeans(c3, ref, d, a, h, gpuid, info, scenes, vectors, causal), c3, ref, reach=d), m3, d, a, h, gpuid)
         # Adjust sharp based on h parameter.
         sharp3 = max(0, min(20, sharp - .5 + (h/2.8)))
-        output = PostProcessing(output, c3, defH, strength, sharp3, rn, rgmode, 2)
+        output = Shared("PostProcessing3", lambda: Stage("PostProcessing3", lambda output, c3: PostProcessing(output, c3, defH, strength, sharp3, rn, rgmode, 2, info, GetStrengthMask(c3), fused, GetDetailMask(c3, 2), scenes, causal), output, c3, reach=ppreach), *pp)
         # output in YCgCoR format
 
     # Add Depth (thicken lines for anime)
     if depth:
         depth2 = -depth*3
         depth = depth*2
-        output = core.std.MergeDiff(output, core.std.MakeDiff(output.warp.AWarpSharp2(128, 3, 1, depth2, 1), output.warp.AWarpSharp2(128, 2, 1, depth, 1)))
+        output = Stage("depth", lambda output: core.std.MergeDiff(output, core.std.MakeDiff(output.warp.AWarpSharp2(128, 3, 1, depth2, 1), output.warp.AWarpSharp2(128, 2, 1, depth, 1))), output)
     
     # Apply deband
     if deband:
         if output.format.bits_per_sample > 16:
             output = ConvertBits(output, 16, fulls, False)
-        output = output.neo_f3kdb.Deband(range=16, preset="high" if dochroma else "luma", grainy=defH/15, grainc=defH/16 if dochroma else 0)
+        output = Stage("deband", lambda output: output.neo_f3kdb.Deband(range=16, preset="high" if dochroma else "luma", grainy=defH/15, grainc=defH/16 if dochroma else 0), output)
 
     # Convert to desired output format and bitrate
-    output = YCgCoR_to_RGB(output, fulls) if conv else output
-    if clip.format.color_family == vs.YUV:
-        output = ConvertMatrix(output, vs.YUV, fulls, matrix)
-        if downchroma and samp != "444":
-            output = output.fmtc.resample(css=samp, cplace=cplace, fulls=fulls, fulld=fulls, kernel="bicubic", a1=0, a2=0.5)
-    if output.format.bits_per_sample != outbits:
-        output = output.fmtc.bitdepth(bits=outbits, fulls=fulls, fulld=fulls, dmode=dmode)
+    def ConvertOutput(output: vs.VideoNode) -> vs.VideoNode:
+        output = ConvertColorspace(output, "YCgCoR", csp, fulls, matrix) if conv else output
+        if clip.format.color_family == vs.YUV:
+            if downchroma and samp != "444":
+                output = output.fmtc.resample(css=samp, cplace=cplace, fulls=fulls, fulld=fulls, kernel="bicubic", a1=0, a2=0.5)
+        if output.format.bits_per_sample != outbits:
+            output = output.fmtc.bitdepth(bits=outbits, fulls=fulls, fulld=fulls, dmode=dmode)
+        return output
+    output = Stage("output", ConvertOutput, output)
      
     # Merge source chroma planes if not processing chroma.
     if not dochroma and uv.format.color_family == vs.YUV:
         if uv.format.bits_per_sample != outbits:
             uv = ConvertBits(uv, outbits, fulls, True)
         output = core.std.ShufflePlanes([output, uv], [0, 1, 2], vs.YUV)
-    
+
+    if scenes:
+        output = core.std.CopyFrameProps(output, scenes, ["_SceneChangePrev"] if causal else ["_SceneChangePrev", "_SceneChangeNext"])
     return output
 
 
-def PostProcessing(clean: vs.VideoNode, c: vs.VideoNode, defH: int, strength: int, sharp: float, rn: float, rgmode: int, method: int) -> vs.VideoNode:
-    fulls = GetColorRange(c) == 0
-    if rgmode == 0:
+# Configurations tried by xCleanAuto, from highest quality to fastest
+AUTO_LADDER = [
+    dict(m1=.6, m2=2, radius=1, d=2, block_step=4, bm_range=16, ps_range=8),
+    dict(m1=.6, m2=2, radius=0, d=2, block_step=4, bm_range=16, ps_range=8),
+    dict(m1=.6, m2=2, radius=0, d=2, block_step=5, bm_range=7, ps_range=5),
+    dict(m1=.6, m2=3.8, radius=0, d=2, block_step=5, bm_range=7, ps_range=5),
+    dict(m1=.5, m2=3.7, radius=0, d=2, block_step=5, bm_range=7, ps_range=5),
+    dict(m1=.5, m2=3.6, radius=0, d=1, block_step=5, bm_range=7, ps_range=5),
+    dict(m1=.5, m2=3.5, radius=0, d=1, block_step=7, bm_range=7, ps_range=5),
+    dict(m1=.5, m2=0, radius=0, d=1, block_step=7, bm_range=7, ps_range=5),
+]
+
+# Picks the highest quality configuration from AUTO_LADDER that meets the frames-per-second and memory (MB) budget
+def xCleanAuto(clip: vs.VideoNode, target_fps: Optional[float] = None, max_memory: Optional[float] = None, samples: int = 4, **kwargs) -> vs.VideoNode:
+    if not target_fps and not max_memory:
+        raise ValueError("xCleanAuto: target_fps or max_memory must be specified")
+    if samples < 1:
+        raise ValueError("xCleanAuto: samples must be at least 1")
+
+    configs = []
+    for config in AUTO_LADDER:
+        config = dict(config, **kwargs)
+        if config not in configs:
+            configs.append(config)
+
+    # Sample from the middle of the clip, the first frame of each run includes warm-up (GPU init, temporal windows)
+    start = max(0, min(clip.num_frames - samples - 1, clip.num_frames // 2))
+    chosen, fps = configs[-1], 0
+    for config in configs:
+        if max_memory and EstimateMemory(clip, **config) > max_memory:
+            continue
+        fps = MeasureFps(xClean(clip, **config)[start:start + samples + 1], 1)
+        if not target_fps or fps >= target_fps:
+            chosen = config
+            break
+
+    output = xClean(clip, **chosen)
+    props = {"xClean_" + k: v for k, v in chosen.items() if k in AUTO_LADDER[0]}
+    return output.std.SetFrameProps(xClean_fps=fps, **props)
+
+# Frames per second rendering clip, excluding the first warmup frames
+def MeasureFps(clip: vs.VideoNode, warmup: int = 0) -> float:
+    frames = clip.frames(prefetch=core.num_threads)
+    for _ in range(warmup):
+        next(frames)
+    start = time.perf_counter()
+    count = sum(1 for _ in frames)
+    return count / max(time.perf_counter() - start, 1e-6)
+
+# Rough peak memory usage estimate of xClean in MB, based on the frames each pass holds in its temporal window
+# at its processing bit depth and size, for every thread working on a frame, plus the framebuffer cache (CacheFloor by default).
+def EstimateMemory(clip: vs.VideoNode, m1: float = .6, m2: float = 2, m3: float = 2, radius: int = 0, d: int = 2, threads: Optional[int] = None, cache: Optional[float] = None, **kwargs) -> float:
+    pixels = clip.width * clip.height * (1 if clip.format.color_family == vs.GRAY else 3)
+    threads = threads or max(1, core.num_threads)
+    m1r = 1 if m1 == int(m1) else m1 % 1
+    m2r = 1 if m2 == int(m2) else m2 % 1
+    perframe = pixels * 2 * 4 # source, reference and post-processing clips at 16-bit
+    if m1 > 0:
+        tr = 4 if int(m1) == 3 else 3
+        perframe += pixels * m1r * m1r * [1, 1, 2, 4][int(m1)] * (tr * 2 + 1) * 1.5 # Super clip of the Degrain window
+    if m2 > 0:
+        perframe += pixels * m2r * m2r * 4 * (radius * 2 + 1) * 3 # Source, ref and aggregation buffers in 32-bit
+    if m3:
+        perframe += pixels * 2 * (d * 2 + 1) * 2 # Source and ref in 16-bit
+    cache = cache if cache is not None else CacheFloor(clip, threads, m1=m1, m2=m2, m3=m3, radius=radius, d=d, **kwargs)
+    return perframe * threads / (1024 * 1024) + cache
+
+# Framebuffer cache in MB holding the temporal window of every thread's frame at 16-bit, so that neighbour frames aren't rendered twice
+def CacheFloor(clip: vs.VideoNode, threads: int, **kwargs) -> float:
+    frame = clip.width * clip.height * (1 if clip.format.color_family == vs.GRAY else 3) * 2
+    return frame * (TemporalReach(**kwargs) * 2 + threads) / (1024 * 1024)
+
+
+# Resize factors tried by xCleanBudget for m2, then m1, when lowering threads and radius isn't enough
+BUDGET_SCALES = [.9, .8, .7, .6, .5, .4]
+
+# Runs xClean with the thread count, cache size and m1/m2/radius that fit within a memory budget (MB)
+def xCleanBudget(clip: vs.VideoNode, max_memory: float, threads: Optional[int] = None, min_threads: Optional[int] = None, **kwargs) -> vs.VideoNode:
+    config, threads, cache = PlanMemory(clip, max_memory, threads, min_threads, **kwargs)
+    core.num_threads = threads
+    core.max_cache_size = int(cache)
+    props = {"xClean_" + k: config[k] for k in ["m1", "m2", "radius"]}
+    return xClean(clip, **config).std.SetFrameProps(xClean_threads=threads, xClean_cache=int(cache), **props)
+
+# Highest quality settings and most threads that fit within max_memory, as (settings, threads, cache size in MB)
+def PlanMemory(clip: vs.VideoNode, max_memory: float, threads: Optional[int] = None, min_threads: Optional[int] = None, **kwargs) -> tuple:
+    threads = threads or max(1, core.num_threads)
+    min_threads = min(threads, min_threads or max(1, threads // 2))
+    for config in BudgetLadder(**kwargs):
+        for t in range(threads, min_threads - 1, -1):
+            working = EstimateMemory(clip, **config, threads=t, cache=0)
+            if working + CacheFloor(clip, t, **config) <= max_memory:
+                return config, t, max_memory - working
+    raise ValueError("xCleanBudget: max_memory is too low for any setting, lower min_threads or use xCleanTiled")
+
+# Settings from the given ones down to radius 0, then m2 and m1 downscaled by BUDGET_SCALES
+def BudgetLadder(m1: float = .6, m2: float = 2, radius: int = 0, **kwargs) -> list:
+    m1r = 1 if m1 == int(m1) else m1 % 1
+    m2r = 1 if m2 == int(m2) else m2 % 1
+    ladder = [dict(m1=m1, m2=m2, radius=r) for r in range(radius, -1, -1)]
+    if m2 > 0:
+        ladder += [dict(m1=m1, m2=round(int(m2) + s, 2), radius=0) for s in BUDGET_SCALES if s < m2r]
+    if m1 > 0:
+        ladder += [dict(m1=round(int(m1) + s, 2), m2=ladder[-1]["m2"], radius=0) for s in BUDGET_SCALES if s < m1r]
+    return [dict(kwargs, **config) for config in ladder]
+
+
+# Runs xClean on overlapping tiles sized to a memory budget (MB), and feather-blends the seams
+def xCleanTiled(clip: vs.VideoNode, max_memory: Optional[float] = None, tiles: Optional[tuple] = None, overlap: Optional[int] = None, **kwargs) -> vs.VideoNode:
+    if not max_memory and not tiles:
+        raise ValueError("xCleanTiled: max_memory or tiles must be specified")
+    gates = [name for name in ("scenecut", "bypass", "bypassbm3d", "mvadapt") if kwargs.get(name)]
+    if gates:
+        raise ValueError(f"xCleanTiled: {', '.join(gates)} can't be used with tiles, each tile would decide on its own")
+    width = clip.width
+    height = clip.height
+    defH = kwargs.pop("defh", None) or max(height, width // 4 * 3)
+    overlap = overlap or TileOverlap(defH, **kwargs)
+    if overlap % 8:
+        raise ValueError("xCleanTiled: overlap must be a multiple of 8")
+    cols, rows = tiles or TileGrid(clip, max_memory, overlap, **kwargs)
+    xs = TileSplits(width, cols)
+    ys = TileSplits(height, rows)
+    if min(b - a for a, b in zip(xs, xs[1:])) < overlap or min(b - a for a, b in zip(ys, ys[1:])) < overlap:
+        raise ValueError("xCleanTiled: tiles must be larger than overlap")
+
+    half = overlap // 2
+    output = None
+    for r in range(rows):
+        row = None
+        for col in range(cols):
+            # Denoise with full context, then keep half of it for blending
+            left, right = max(0, xs[col] - overlap), min(width, xs[col + 1] + overlap)
+            top, bottom = max(0, ys[r] - overlap), min(height, ys[r + 1] + overlap)
+            tile = xClean(clip.std.Crop(left, width - right, top, height - bottom), defh=defH, **kwargs)
+            tile = tile.std.Crop(max(0, xs[col] - half) - left, right - min(width, xs[col + 1] + half),
+                                 max(0, ys[r] - half) - top, bottom - min(height, ys[r + 1] + half))
+            row = Feather(row, tile, overlap, False) if row else tile
+        output = Feather(output, row, overlap, True) if output else row
+    return output
+
+# Joins a and b, whose last and first overlap columns (or rows) cover the same area, with a linear ramp over the overlap
+def Feather(a: vs.VideoNode, b: vs.VideoNode, overlap: int, vertical: bool) -> vs.VideoNode:
+    peak = 1 if a.format.sample_type == vs.FLOAT else (1 << a.format.bits_per_sample) - 1
+    if vertical:
+        aov = a.std.Crop(top=a.height - overlap)
+        bov = b.std.Crop(bottom=b.height - overlap)
+        mask = core.akarin.Expr(aov, f"Y 0.5 + height / {peak} *")
+        return core.std.StackVertical([a.std.Crop(bottom=overlap), core.std.MaskedMerge(aov, bov, mask), b.std.Crop(top=overlap)])
+    aov = a.std.Crop(left=a.width - overlap)
+    bov = b.std.Crop(right=b.width - overlap)
+    mask = core.akarin.Expr(aov, f"X 0.5 + width / {peak} *")
+    return core.std.StackHorizontal([a.std.Crop(right=overlap), core.std.MaskedMerge(aov, bov, mask), b.std.Crop(left=overlap)])
+
+# Tile boundaries splitting size into count parts, aligned to 4 pixels for subsampled and downscaled passes
+def TileSplits(size: int, count: int) -> list:
+    return [0] + [round(size * i / count / 4) * 4 for i in range(1, count)] + [size]
+
+# Context needed on each side of a tile: MVTools blocks and padding, BM3D block matching and predictive search (at m2 scale), KNLMeans search window
+def TileOverlap(defH: int, m2: float = 2, bm_range: int = 16, ps_range: int = 8, a: int = 2, **kwargs) -> int:
+    sc = 8 if defH > 2880 else 4 if defH > 1440 else 2 if defH > 720 else 1
+    bs = 16 if defH / sc > 360 else 8
+    m2r = 1 if m2 == int(m2) else m2 % 1
+    overlap = max(bs * 4, math.ceil((bm_range + ps_range + 8) / m2r) if m2 > 0 else 0, a + 4)
+    return -(-overlap // 8) * 8
+
+# Smallest grid of tiles whose estimated memory usage fits within max_memory. Threads work on tiles of any frame at once, each
+# with its working memory at tile size, and every tile node caches its own temporal window: the cache holds all tiles.
+def TileGrid(clip: vs.VideoNode, max_memory: float, overlap: int, **kwargs) -> tuple:
+    grids = sorted(((cols, rows) for cols in range(1, 17) for rows in range(1, 17)),
+        key=lambda g: (g[0] * g[1], abs(math.log(clip.width / g[0] / (clip.height / g[1])))))
+    threads = max(1, core.num_threads)
+    for cols, rows in grids:
+        tw = min(clip.width, -(-clip.width // cols // 4) * 4 + overlap * 2)
+        th = min(clip.height, -(-clip.height // rows // 4) * 4 + overlap * 2)
+        tile = core.std.BlankClip(clip, width=tw, height=th, length=1)
+        if EstimateMemory(tile, threads=threads, cache=0, **kwargs) + CacheFloor(tile, threads, **kwargs) * cols * rows <= max_memory:
+            return cols, rows
+    raise ValueError("xCleanTiled: max_memory is too low for any tile size")
+
+
+# Selects per frame between all passes, processing without BM3D and passthrough, based on the estimated noise level
+def NoiseGate(clip: vs.VideoNode, build, bypass: float, bypassbm3d: float, causal: bool = False) -> vs.VideoNode:
+    full = build()
+    clips = [full.std.SetFrameProps(xClean_bypass=0)]
+    if bypassbm3d > 0:
+        clips.append(build(m2=0).std.SetFrameProps(xClean_bypass=1))
+    if bypass > 0:
+        clips.append(clip.resize.Bicubic(format=full.format.id, dither_type="error_diffusion").std.SetFrameProps(xClean_bypass=2))
+    thresholds = ([bypassbm3d] if bypassbm3d > 0 else []) + ([bypass] if bypass > 0 else [])
+
+    noise = NoiseLevel(clip)
+    window = [ShiftFrames(noise, k) for k in (range(-4, 1) if causal else range(-2, 3))]
+    Level = lambda f: sum(p.props["PlaneStatsAverage"] for p in f) / len(f)
+    def Select(n, f):
+        return clips[sum(1 for t in thresholds if Level(f) < t)]
+    def SetProps(n, f):
+        fout = f[0].copy()
+        fout.props["xClean_noise"] = Level(f[1:])
+        return fout
+    gated = core.std.FrameEval(full, Select, prop_src=window, clip_src=clips)
+    return core.std.ModifyFrame(gated, [gated] + window, SetProps)
+
+# Per-frame noise standard deviation estimate in 8-bit units (Immerkaer's fast method), as PlaneStatsAverage of a Laplacian residual
+def NoiseLevel(clip: vs.VideoNode) -> vs.VideoNode:
+    y = core.std.ShufflePlanes(clip, 0, vs.GRAY)
+    scale = (255 if y.format.sample_type == vs.FLOAT else 255 / ((1 << y.format.bits_per_sample) - 1)) * math.sqrt(math.pi / 2) / 6
+    laplacian = "x 4 * x[-1,0] x[1,0] + x[0,-1] + x[0,1] + 2 * - x[-1,-1] + x[1,-1] + x[-1,1] + x[1,1] +"
+    return core.akarin.Expr(y, f"{laplacian} abs {scale} *", format=vs.GRAYS).std.PlaneStats()
+
+# Shifts frames by k, frame n of the result is frame n+k of c, repeating the first or last frame at the ends
+def ShiftFrames(c: vs.VideoNode, k: int) -> vs.VideoNode:
+    if k > 0:
+        return c[k:] + c[-1] * k
+    if k < 0:
+        return c[0] * -k + c[:k]
+    return c
+
+
+# Small clip carrying _SceneChangePrev and _SceneChangeNext props, from the luma difference between consecutive frames.
+# The first and last frames are always cuts, so that chunks split at cuts render the same as the whole clip.
+# With causal, only _SceneChangePrev is set and frame n doesn't read frame n+1.
+def SceneChanges(clip: vs.VideoNode, threshold: float, causal: bool = False) -> vs.VideoNode:
+    y = core.std.ShufflePlanes(clip, 0, vs.GRAY).resize.Bilinear(max(8, clip.width // 16 * 4), max(8, clip.height // 16 * 4), format=vs.GRAY8)
+    diff = core.std.PlaneStats(y, ShiftFrames(y, -1)) # Frame n compared with n-1
+    last = clip.num_frames - 1
+    def SetProps(n, f):
+        fout = f[0].copy()
+        fout.props["_SceneChangePrev"] = int(n == 0 or f[0].props["PlaneStatsDiff"] > threshold)
+        if not causal:
+            fout.props["_SceneChangeNext"] = int(n == last or f[1].props["PlaneStatsDiff"] > threshold)
+        return fout
+    return core.std.ModifyFrame(diff, [diff] if causal else [diff, ShiftFrames(diff, 1)], SetProps)
+
+# Number of frames on each side of frame n, up to radius, that can be read without crossing a scene cut.
+# props are the frames n-radius .. n+radius of a SceneChanges clip. A cut is flagged on either side, so that
+# the repeated frames past the ends of a chunk still see it. With causal, props are the frames n-radius .. n only.
+def SceneDistance(props: list, radius: int, causal: bool = False) -> int:
+    for r in range(1, radius + 1):
+        lo, hi = radius - r, radius + r
+        if causal:
+            if props[lo + 1]["_SceneChangePrev"]:
+                return r - 1
+        elif props[lo]["_SceneChangeNext"] or props[lo + 1]["_SceneChangePrev"] or props[hi - 1]["_SceneChangeNext"] or props[hi]["_SceneChangePrev"]:
+            return r - 1
+    return radius
+
+# Selects per frame the widest variant whose window doesn't cross a scene cut. variants[r] reads up to r * reach frames on each side,
+# or only before the frame with causal.
+def SceneGate(variants: list, scenes: Optional[vs.VideoNode], reach: int = 1, causal: bool = False) -> vs.VideoNode:
+    if not scenes or len(variants) == 1:
+        return variants[-1]
+    radius = (len(variants) - 1) * reach
+    window = [ShiftFrames(scenes, k) for k in range(-radius, 1 if causal else radius + 1)]
+    def Select(n, f):
+        return variants[SceneDistance([p.props for p in f], radius, causal) // reach]
+    return core.std.FrameEval(variants[-1], Select, prop_src=window, clip_src=variants)
+
+# Radius 1 temporal median, skipped on frames next to a scene cut. With causal, median of the frame and its previous 2 frames.
+def SceneMedian(c: vs.VideoNode, scenes: Optional[vs.VideoNode], planes: Optional[list] = None, causal: bool = False) -> vs.VideoNode:
+    if causal:
+        expr = "x y min x y max z min max"
+        median = core.std.Expr([c, ShiftFrames(c, -1), ShiftFrames(c, -2)], [expr if planes is None or i in planes else "" for i in range(c.format.num_planes)])
+        return SceneGate([c, median], scenes, 2, True)
+    median = c.tmedian.TemporalMedian(1, planes) if planes else c.tmedian.TemporalMedian()
+    return SceneGate([c, median], scenes)
+
+
+# Number of frames before and after each output frame that xClean reads from its input with the given settings.
+# Each pass feeds the next one, so the reach of every enabled pass adds up. Post-processing chains two radius 1 temporal medians.
+# With causal, windows only read previous frames but some reach further back (mvadapt and noise bypass average 4 previous frames).
+def TemporalReach(m1: float = .6, m2: float = 2, m3: float = 2, radius: int = 0, d: int = 2, rgmode: int = 18, bypass: float = 0, bypassbm3d: float = 0, mvadapt: bool = False, causal: bool = False, **kwargs) -> int:
+    pp = 2 if rgmode > 0 else 0
+    reach = 0
+    if m1 > 0:
+        degrain = 4 if int(m1) == 3 else 3
+        if mvadapt:
+            degrain = max(degrain, (4 if causal else 2) + 1) # Motion stats window, of delta 1 vectors
+        reach += degrain + 1 + pp # Degrain3/4, then chroma temporal median
+    if m2 > 0 and not causal:
+        reach += radius * 2 + pp # BM3D temporal blocks, then VAggregate
+    elif m2 > 0:
+        reach += pp
+    if m3 > 0:
+        reach += d + pp
+    return max(reach, 4 if causal else 2) if bypass > 0 or bypassbm3d > 0 else reach
+
+
+# Source frame properties, read once with a single frame request and passed through the pipeline.
+# Reading properties from intermediate nodes would render frame 0 through the whole upstream denoising chain.
+class ClipInfo(NamedTuple):
+    fulls: bool
+    matrix: int
+    transfer: int
+    primaries: int
+    chromaloc: int
+
+def GetClipInfo(c: vs.VideoNode) -> ClipInfo:
+    props = c.get_frame(0).props
+    isRGB = c.format.color_family == vs.RGB
+    fulls = isRGB or GetProp(props, "_ColorRange", 1) == 0
+    matrix = 0 if isRGB else GetProp(props, "_Matrix", 1)
+    matrix = 6 if matrix in [0, 2] and not isRGB else matrix
+    transfer = GetProp(props, "_Transfer", 0)
+    primaries = GetProp(props, "_Primaries", 0)
+    return ClipInfo(
+        fulls       = fulls,
+        matrix      = matrix,
+        transfer    = matrix if transfer in [0, 2] else transfer,
+        primaries   = matrix if primaries in [0, 2] else primaries,
+        chromaloc   = GetProp(props, "_ChromaLocation", 0))
+
+
+# Memoized conversion planner. Each (bit depth, colorspace, scale) variant of the source is built once per xClean call,
+# and only when a pass requests it, so that passes share the same nodes instead of duplicating them.
+class ConvPlanner:
+    def __init__(self, source: vs.VideoNode, csp: str, fulls: bool, matrix: int, profile = None):
+        self.source = source
+        self.csp = csp
+        self.fulls = fulls
+        self.matrix = matrix
+        self.profile = profile
+        self.nodes = {}
+
+    # Returns source at given bit depth, resized by scale (with fmtc.resample arguments), in given colorspace.
+    def Get(self, bits: int, csp: Optional[str] = None, scale: float = 1, **resample) -> vs.VideoNode:
+        csp = csp or self.csp
+        resample = resample if scale < 1 else {}
+        key = (bits, csp, scale if scale < 1 else 1, tuple(sorted(resample.items())))
+        if not key in self.nodes:
+            if csp != self.csp:
+                convert = lambda c: ConvertColorspace(c, self.csp, csp, self.fulls, self.matrix)
+                c = self.Get(bits, None, scale, **resample)
+                c = self.profile.Wrap(f"colorspace_{csp}_{bits}", convert, c) if self.profile else convert(c)
+            elif scale < 1:
+                c = self.Get(bits).fmtc.resample((self.source.width * scale)//4*4, (self.source.height * scale)//4*4, **resample)
+            else:
+                c = ConvertBits(self.source, bits, self.fulls, bits < 32)
+            self.nodes[key] = c
+        return self.nodes[key]
+
+    # Memoizes any other node shared between passes, build is only called the first time key is requested.
+    def Memo(self, key: tuple, build) -> vs.VideoNode:
+        if not key in self.nodes:
+            self.nodes[key] = build()
+        return self.nodes[key]
+
+
+# Opt-in per-stage profiler, pass an instance to xClean(profile=...).
+# For each frame, records the wall time between all the input frames a stage reads for it being ready (or the frame being requested,
+# whichever is later) and its output being ready, so that temporal stages aren't charged for rendering their upstream neighbours.
+# Times are attached to output frames as xClean_<stage>_ms props, and aggregated by Report().
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = {}
+        self.requested = {}
+        self.times = {}
+
+    # Builds a stage from probed inputs and times its output. Output frame n reads input frames n-before .. n+after.
+    def Wrap(self, name: str, build, *inputs, before: int = 0, after: int = 0) -> vs.VideoNode:
+        output = build(*[self.Probe(name, c) if c else c for c in inputs])
+        prop = f"xClean_{name}_ms"
+
+        def Done(n, f):
+            end = time.perf_counter()
+            with self.lock:
+                ready = self.ready.setdefault(name, {})
+                start = max([ready.get(m, 0) for m in range(n - before, n + after + 1)] + [self.requested.pop((name, n), end)])
+                ms = (end - start) * 1000
+                self.times.setdefault(name, {})[n] = ms
+                # Frames still in flight read inputs from n - before - num_threads on, older ones are no longer needed
+                for m in [m for m in ready if m < n - before - max(1, core.num_threads)]:
+                    del ready[m]
+            fout = f.copy()
+            fout.props[prop] = ms
+            return fout
+
+        def Requested(n):
+            with self.lock:
+                self.requested[(name, n)] = time.perf_counter()
+            return timed
+
+        timed = core.std.ModifyFrame(output, output, Done)
+        return core.std.FrameEval(timed, Requested)
+
+    def Probe(self, name: str, clip: vs.VideoNode) -> vs.VideoNode:
+        def Ready(n, f):
+            now = time.perf_counter()
+            with self.lock:
+                ready = self.ready.setdefault(name, {})
+                ready[n] = max(ready.get(n, now), now)
+            return f
+        return core.std.ModifyFrame(clip, clip, Ready)
+
+    # Per-stage frame count, total, mean and max time in milliseconds
+    def Report(self) -> dict:
+        with self.lock:
+            return {name: {
+                "frames": len(t),
+                "total_ms": sum(t.values()),
+                "mean_ms": sum(t.values()) / len(t),
+                "max_ms": max(t.values()),
+            } for name, t in self.times.items() if t}
+
+
+def PostProcessing(clean: vs.VideoNode, c: vs.VideoNode, defH: int, strength: int, sharp: float, rn: float, rgmode: int, method: int, info: Optional[ClipInfo] = None, mask: Optional[vs.VideoNode] = None, fused: bool = False, dmask: Optional[vs.VideoNode] = None, scenes: Optional[vs.VideoNode] = None, causal: bool = False) -> vs.VideoNode:
+    fulls = (info or GetClipInfo(c)).fulls
+    # Light post-processing when a shared detail mask is given: no sharpening nor renoise
+    if rgmode == 0 or dmask:
         sharp = rn = 0
 
     # Run at least in 16-bit
@@ -317,33 +891,30 @@ def PostProcessing(clean: vs.VideoNode, c: vs.VideoNode, defH: int, strength: in
 
     # Apply dynamic noise reduction strength based on Luma
     if strength <= 0:
-        # Slightly widen the exclusion mask to preserve details and edges
-        cleanm = cy.std.Maximum()
-        if defH > 500:
-            cleanm = cleanm.std.Maximum()
-        if defH > 1200:
-            cleanm = cleanm.std.Maximum()
-
-        # Adjust mask levels
-        cleanm = cleanm.std.Levels((0 if fulls else 16) - strength, 255 if fulls else 235, 0.85, 0, 255+strength)
+        cleanm = mask or StrengthMask(cy, defH, strength, fulls)
 
         # Merge based on luma mask
         clean = core.std.MaskedMerge(clean, cy, cleanm)
         clean2 = core.std.MaskedMerge(clean2, cy, cleanm)
-        filt = core.std.MaskedMerge(filt, c, cleanm)
+        filt = core.std.MaskedMerge(filt, c, cleanm, first_plane=ClipSampling(c) in ["420", "422"])
     elif strength < 20:
         # Reduce strength by partially merging back with original
         clean = core.std.Merge(cy, clean, 0.2+0.04*strength)
         clean2 = core.std.Merge(cy, clean2, 0.2+0.04*strength)
         filt = core.std.Merge(c, filt, 0.2+0.04*strength)
 
-    # Unsharp filter for spatial detail enhancement
     if sharp:
-        RE = core.rgsf.Repair if bd == 32 else core.rgvs.Repair
         mult = .69 if method == 2 else .14 if method == 1 else 1
         sharp = min(50, (15 + defH * sharp * 0.0007) * mult)
+    if fused and not dmask:
+        clean2 = FusedLumaPP(clean, clean2, cy, sharp, rn, rgmode, fulls, scenes, causal)
+        return core.std.ShufflePlanes([clean2, filt], [0, 1, 2], vs.YUV) if c.format.color_family == vs.YUV else clean2
+
+    # Unsharp filter for spatial detail enhancement
+    if sharp:
+        RE = core.rgsf.Repair if bd == 32 else core.rgvs.Repair
         clsharp = core.std.MakeDiff(clean, Sharpen(clean2, amountH=-0.08-0.03*sharp))
-        clsharp = core.std.MergeDiff(clean2, RE(clsharp.tmedian.TemporalMedian(), clsharp, 12))
+        clsharp = core.std.MergeDiff(clean2, RE(SceneMedian(clsharp, scenes, causal=causal), clsharp, 12))
     
     # If selected, combining ReNoise
     noise_diff = core.std.MakeDiff(clean2, cy)
@@ -352,23 +923,180 @@ def PostProcessing(clean: vs.VideoNode, c: vs.VideoNode, defH: int, strength: in
         i = 0.00392 if bd == 32 else 1 << (bd - 8)
         peak = 1.0 if bd == 32 else (1 << bd) - 1
         expr = "x {a} < 0 x {b} > {p} 0 x {c} - {p} {a} {d} - / * - ? ?".format(a=32*i, b=45*i, c=35*i, d=65*i, p=peak)
-        clean1 = core.std.Merge(clean2, core.std.MergeDiff(clean2, Tweak(noise_diff.tmedian.TemporalMedian(), cont=1.008+0.00016*rn)), 0.3+rn*0.035)
+        clean1 = core.std.Merge(clean2, core.std.MergeDiff(clean2, Tweak(SceneMedian(noise_diff, scenes, causal=causal), cont=1.008+0.00016*rn, fulls=fulls)), 0.3+rn*0.035)
         clean2 = core.std.MaskedMerge(clean2, clean1, core.std.Expr([core.std.Expr([clean, clean.std.Invert()], 'x y min')], [expr]))
 
     # Combining spatial detail enhancement with spatial noise reduction using prepared mask
-    noise_diff = noise_diff.std.Binarize().std.Invert()
-    if rgmode > 0:
+    if dmask:
+        clean2 = core.std.MaskedMerge(clean2, clean, dmask)
+    elif rgmode > 0:
+        noise_diff = noise_diff.std.Binarize().std.Invert()
         clean2 = core.std.MaskedMerge(clean2, clsharp if sharp else clean, core.std.Expr([noise_diff, clean.std.Sobel()], 'x y max'))
 
     # Combining result of luma and chroma cleaning
     return core.std.ShufflePlanes([clean2, filt], [0, 1, 2], vs.YUV) if c.format.color_family == vs.YUV else clean2
 
 
+# Luma part of PostProcessing with all pointwise and 3x3 stages fused into two akarin.Expr kernels around the temporal
+# median and Repair calls, which avoids ~15 full-frame intermediate clips. Results match the unfused chain within 1 LSB
+# (intermediates are no longer rounded), except on frame borders where pixel access uses mirrored edges.
+def FusedLumaPP(clean: vs.VideoNode, clean2: vs.VideoNode, cy: vs.VideoNode, sharp: float, rn: float, rgmode: int, fulls: bool, scenes: Optional[vs.VideoNode] = None, causal: bool = False) -> vs.VideoNode:
+    bd = clean.format.bits_per_sample
+    isFLOAT = bd == 32
+    peak = 1.0 if isFLOAT else (1 << bd) - 1
+    mid = 0 if isFLOAT else 1 << (bd - 1)
+    clamp = "" if isFLOAT else f" 0 max {peak} min"
+    clips = [clean, clean2, cy] # x, y, z, then a, b
+
+    # Sharpen() as a single 3x3 kernel, then MakeDiff with clean
+    if sharp:
+        amount = -0.08-0.03*sharp
+        outer = math.floor((0.25 - 2 ** (amount - 2)) * 1023 + 0.5)
+        center = math.floor(2 ** (amount - 1) * 1023 + 0.5)
+        w = [outer, center, outer]
+        taps = [f"y[{dx},{dy}] {w[dx+1] * w[dy+1]} *" for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
+        kernel = " ".join(taps[:1] + [t + " +" for t in taps[1:]]) + f" {sum(w) ** 2} /"
+        clsharp = core.akarin.Expr([clean, clean2], f"x {kernel} -" + ("" if isFLOAT else f" {mid} +"), boundary=1)
+        RE = core.rgsf.Repair if isFLOAT else core.rgvs.Repair
+        clips.append(RE(SceneMedian(clsharp, scenes, causal=causal), clsharp, 12))
+
+    # Renoise: Tweak(TemporalMedian(clean2 - cy)) merged back into clean2 through the luma ramp mask
+    expr = "y B!"
+    if rn:
+        clips.append(SceneMedian(core.std.MakeDiff(clean2, cy), scenes, causal=causal))
+        n = "b" if sharp else "a"
+        cont = 1.008+0.00016*rn
+        luma_min = 16  << (bd - 8) if not fulls and not isFLOAT else 0
+        luma_max = 235 << (bd - 8) if not fulls and not isFLOAT else peak
+        tweak = f"{n} {cont} * 0 max 1 min" if isFLOAT else f"{n} {luma_min} - {cont} * {luma_min} + 0.5 + floor {luma_min} max {luma_max} min"
+        i = 0.00392 if isFLOAT else 1 << (bd - 8)
+        ramp = "V@ {a} < 0 V@ {b} > {p} 0 V@ {c} - {p} {a} {d} - / * - ? ?".format(a=32*i, b=45*i, c=35*i, d=65*i, p=peak)
+        expr += f" x {peak} x - min V! {ramp}{clamp} R!"
+        expr += f" y {tweak} + {mid} -{clamp} M!"
+        expr += f" y M@ y - {0.3+rn*0.035} * + C!"
+        expr += f" y C@ y - R@ * {peak} / + B!"
+
+    # Detail mask: max(Invert(Binarize(clean2 - cy)), Sobel(clean)), selects between sharpened and renoised luma
+    if rgmode > 0:
+        sh = (f"y a + {mid} -{clamp}" if sharp else "x") + " H!"
+        nd = f"y z - {mid} +{clamp}"
+        binv = f"{nd} {0.5 if isFLOAT else mid} >= 0 {peak} ?"
+        gx = "x[1,-1] x[1,0] 2 * + x[1,1] + x[-1,-1] x[-1,0] 2 * + x[-1,1] + -"
+        gy = "x[-1,1] x[0,1] 2 * + x[1,1] + x[-1,-1] x[0,-1] 2 * + x[1,-1] + -"
+        sobel = f"{gx} dup * {gy} dup * + sqrt {peak} min"
+        expr += f" {sh} {binv} {sobel} max K! B@ H@ B@ - K@ * {peak} / +"
+    else:
+        expr += " B@"
+    return core.akarin.Expr(clips, expr, boundary=1)
+
+
+# Noise and edge mask computed from the source luma instead of the denoised clip, so that it can be shared between passes
+def DetailMask(cy: vs.VideoNode, rgmode: int) -> vs.VideoNode:
+    RG = core.rgsf.RemoveGrain if cy.format.bits_per_sample == 32 else core.rgvs.RemoveGrain
+    noise_diff = core.std.MakeDiff(RG(cy, rgmode), cy).std.Binarize().std.Invert()
+    return core.std.Expr([noise_diff, cy.std.Sobel()], 'x y max')
+
+
+# Luma mask for Dynamic Denoiser Strength
+def StrengthMask(cy: vs.VideoNode, defH: int, strength: int, fulls: bool) -> vs.VideoNode:
+    # Slightly widen the exclusion mask to preserve details and edges
+    cleanm = cy.std.Maximum()
+    if defH > 500:
+        cleanm = cleanm.std.Maximum()
+    if defH > 1200:
+        cleanm = cleanm.std.Maximum()
+
+    # Adjust mask levels
+    return cleanm.std.Levels((0 if fulls else 16) - strength, 255 if fulls else 235, 0.85, 0, 255+strength)
+
+
+# MVTools vectors for deltas 1 to 3 (4 in 32-bit), and the Super settings to use them with. bvec is empty when causal.
+class MotionVectors(NamedTuple):
+    bvec: list
+    fvec: list
+    width: int
+    height: int
+    sargs: dict
+    icalc: bool
+
+
 # mClean denoising method
-def MvTools(c: vs.VideoNode, defH: int, thSAD: int) -> vs.VideoNode:
+def MvTools(c: vs.VideoNode, defH: int, thSAD: int, info: Optional[ClipInfo] = None, scenes: Optional[vs.VideoNode] = None, cache: Optional[str] = None, vectors: Optional[MotionVectors] = None, adaptive: bool = False, causal: bool = False) -> vs.VideoNode:
     bd = c.format.bits_per_sample
-    fulls = GetColorRange(c) == 0
+    fulls = (info or GetClipInfo(c)).fulls
     icalc = bd < 32
+    vectors = vectors or AnalyseVectors(c, defH, cache, causal)
+    D = core.mv if icalc else core.mvsf
+    super2 = D.Super(c, rfilter=1, levels=1, **vectors.sargs)
+
+    # Applying cleaning, Degrain3 (Degrain4 in 32-bit)
+    if causal:
+        # Forward vectors compensate previous frames, Compensate keeps the frame's own blocks where SAD is above thsad
+        past = [D.Compensate(c, super2, vec, thsad=thSAD) for vec in vectors.fvec]
+        Degrain = lambda r: core.std.AverageFrames([c] + past[:r], [1] * (r + 1))
+    else:
+        vecs = [vec for pair in zip(vectors.bvec, vectors.fvec) for vec in pair]
+        Degrain = lambda r: getattr(D, f"Degrain{r}")(c, super2, *vecs[:r * 2], thsad=thSAD)
+    clean = Degrain(len(vectors.fvec))
+    if scenes or adaptive:
+        variants = [c] + [Degrain(r) for r in range(1, len(vectors.fvec))] + [clean]
+        if adaptive:
+            stats = MotionStats(c, vectors.fvec[0] if causal else vectors.bvec[0], vectors.sargs["pel"])
+            variants = variants[:1] + [MotionGate(variants[:r + 1], stats, causal) for r in range(1, len(variants))]
+        # Fewer vectors near scene cuts, no temporal denoising on the frames right next to them
+        clean = SceneGate(variants, scenes, causal=causal)
+
+    if bd < 16:
+        clean = ConvertBits(clean, 16, fulls, False)
+        c = ConvertBits(c, 16, fulls, False)
+
+    if c.format.color_family == vs.YUV:
+        uv = core.std.MergeDiff(clean, SceneMedian(core.std.MakeDiff(c, clean, [1, 2]), scenes, [1, 2], causal), [1, 2])
+        clean = core.std.ShufflePlanes(clips=[clean, uv], planes=[0, 1, 2], colorfamily=vs.YUV)
+    return clean
+
+
+# Motion (in pixels) and SAD (per 8x8 block) above which the mv.Mask of the delta 1 vectors saturates
+MV_MOTION_ML = 32
+MV_SAD_ML = 1000
+# Adaptive Degrain radius thresholds, see mvadapt
+MV_FAST_MOTION = 8
+MV_CLEAN_SAD = 100
+
+# Average delta 1 motion and SAD per frame, as xClean_motion and xClean_sad props
+def MotionStats(c: vs.VideoNode, vec: vs.VideoNode, pel: int) -> vs.VideoNode:
+    M = core.mv.Mask if c.format.bits_per_sample < 32 else core.mvsf.Mask
+    motion = M(c, vec, kind=0, ml=MV_MOTION_ML * pel).std.PlaneStats()
+    sad = M(c, vec, kind=1, ml=MV_SAD_ML).std.PlaneStats()
+    def SetProps(n, f):
+        fout = f[0].copy()
+        fout.props["xClean_motion"] = f[0].props["PlaneStatsAverage"] * MV_MOTION_ML
+        fout.props["xClean_sad"] = f[1].props["PlaneStatsAverage"] * MV_SAD_ML
+        return fout
+    return core.std.ModifyFrame(motion, [motion, sad], SetProps)
+
+# Picks per frame one of the Degrain variants (variants[r] has radius r) from the MotionStats averaged over 5 frames (the frame and
+# its previous 4 with causal). Long deltas don't find matches on fast motion, and don't add anything on clean frames.
+def MotionGate(variants: list, stats: vs.VideoNode, causal: bool = False) -> vs.VideoNode:
+    window = [ShiftFrames(stats, k) for k in (range(-4, 1) if causal else range(-2, 3))]
+    def Radius(f) -> tuple:
+        motion = sum(p.props["xClean_motion"] for p in f) / len(f)
+        sad = sum(p.props["xClean_sad"] for p in f) / len(f)
+        r = 1 if motion > MV_FAST_MOTION or sad < MV_CLEAN_SAD else 2 if motion > MV_FAST_MOTION / 2 or sad < MV_CLEAN_SAD * 2 else len(variants) - 1
+        return min(r, len(variants) - 1), motion, sad
+    def Select(n, f):
+        return variants[Radius(f)[0]]
+    def SetProps(n, f):
+        fout = f[0].copy()
+        fout.props["xClean_mvradius"], fout.props["xClean_motion"], fout.props["xClean_sad"] = Radius(f[1:])
+        return fout
+    gated = core.std.FrameEval(variants[-1], Select, prop_src=window, clip_src=variants)
+    return core.std.ModifyFrame(gated, [gated] + window, SetProps)
+
+
+# mClean motion analysis. With causal, only the forward vectors (from previous frames) are analysed.
+def AnalyseVectors(c: vs.VideoNode, defH: int, cache: Optional[str] = None, causal: bool = False) -> MotionVectors:
+    icalc = c.format.bits_per_sample < 32
     S = core.mv.Super if icalc else core.mvsf.Super
     A = core.mv.Analyse if icalc else core.mvsf.Analyse
     R = core.mv.Recalculate if icalc else core.mvsf.Recalculate
@@ -382,40 +1110,64 @@ def MvTools(c: vs.VideoNode, defH: int, thSAD: int) -> vs.VideoNode:
 
     ref = c.std.Convolution(matrix=[2, 3, 2, 3, 6, 3, 2, 3, 2])
     super1 = S(ref, hpad=bs, vpad=bs, pel=pel, rfilter=4, sharp=1)
-    super2 = S(c, hpad=bs, vpad=bs, pel=pel, rfilter=1, levels=1)
     analyse_args = { 'blksize': bs, 'overlap': ov, 'search': 5, 'truemotion': truemotion }
     recalculate_args = { 'blksize': bs, 'overlap': ov, 'search': 5, 'truemotion': truemotion, 'thsad': 180, 'lambda': lampa }
 
     # Analysis
-    bvec4 = R(super1, A(super1, isb=True,  delta=4, **analyse_args), **recalculate_args) if not icalc else None
-    bvec3 = R(super1, A(super1, isb=True,  delta=3, **analyse_args), **recalculate_args)
-    bvec2 = R(super1, A(super1, isb=True,  delta=2, badsad=1100, lsad=1120, **analyse_args), **recalculate_args)
-    bvec1 = R(super1, A(super1, isb=True,  delta=1, badsad=1500, lsad=980, badrange=27, **analyse_args), **recalculate_args)
+    bvec4 = R(super1, A(super1, isb=True,  delta=4, **analyse_args), **recalculate_args) if not icalc and not causal else None
+    bvec3 = R(super1, A(super1, isb=True,  delta=3, **analyse_args), **recalculate_args) if not causal else None
+    bvec2 = R(super1, A(super1, isb=True,  delta=2, badsad=1100, lsad=1120, **analyse_args), **recalculate_args) if not causal else None
+    bvec1 = R(super1, A(super1, isb=True,  delta=1, badsad=1500, lsad=980, badrange=27, **analyse_args), **recalculate_args) if not causal else None
     fvec1 = R(super1, A(super1, isb=False, delta=1, badsad=1500, lsad=980, badrange=27, **analyse_args), **recalculate_args)
     fvec2 = R(super1, A(super1, isb=False, delta=2, badsad=1100, lsad=1120, **analyse_args), **recalculate_args)
     fvec3 = R(super1, A(super1, isb=False, delta=3, **analyse_args), **recalculate_args)
     fvec4 = R(super1, A(super1, isb=False, delta=4, **analyse_args), **recalculate_args) if not icalc else None
 
-    # Applying cleaning
-    if icalc:
-        clean = core.mv.Degrain3(c, super2, bvec1, fvec1, bvec2, fvec2, bvec3, fvec3, thsad=thSAD)
-    else:
-        clean = core.mvsf.Degrain4(c, super2, bvec1, fvec1, bvec2, fvec2, bvec3, fvec3, bvec4, fvec4, thsad=thSAD)
-
-    if bd < 16:
-        clean = ConvertBits(clean, 16, fulls, False)
-        c = ConvertBits(c, 16, fulls, False)
-
-    if c.format.color_family == vs.YUV:
-        uv = core.std.MergeDiff(clean, core.tmedian.TemporalMedian(core.std.MakeDiff(c, clean, [1, 2]), 1, [1, 2]), [1, 2])
-        clean = core.std.ShufflePlanes(clips=[clean, uv], planes=[0, 1, 2], colorfamily=vs.YUV)
-    return clean
+    # Vectors only depend on the input clip and analysis settings, vectors of delta tr read tr frames away
+    tr = 3 if icalc else 4
+    if cache:
+        key = Fingerprint(c, "mv", pel, analyse_args, recalculate_args)
+        keys = WindowHash(c, tr)
+        bvec1, bvec2, bvec3, bvec4, fvec1, fvec2, fvec3, fvec4 = [Checkpoint(v, os.path.join(cache, f"mv-{key}", name), keys) if v else None
+            for name, v in zip(["b1", "b2", "b3", "b4", "f1", "f2", "f3", "f4"], [bvec1, bvec2, bvec3, bvec4, fvec1, fvec2, fvec3, fvec4])]
+
+    return MotionVectors([bvec1, bvec2, bvec3, bvec4][:tr] if not causal else [], [fvec1, fvec2, fvec3, fvec4][:tr], c.width, c.height, dict(hpad=bs, vpad=bs, pel=pel), icalc)
+
+
+# Interleaves each frame with its motion-compensated neighbours: radius previous frames, the frame, then radius next frames.
+# Frames are compensated at the size the vectors were analysed at, and resized back. radius can't exceed the number of vectors.
+# With causal, the previous frames are repeated in place of the next ones.
+def CompensatedWindow(clip: vs.VideoNode, vectors: MotionVectors, radius: int, fulls: bool, causal: bool = False) -> vs.VideoNode:
+    bits = clip.format.bits_per_sample
+    resized = (clip.width, clip.height) != (vectors.width, vectors.height)
+    c = clip.resize.Bicubic(vectors.width, vectors.height) if resized else clip
+    c = ConvertBits(c, 16 if vectors.icalc else 32, fulls, False)
+    S = core.mv.Super if vectors.icalc else core.mvsf.Super
+    C = core.mv.Compensate if vectors.icalc else core.mvsf.Compensate
+    super1 = S(c, levels=1, **vectors.sargs)
+    def Compensate(vec: vs.VideoNode) -> vs.VideoNode:
+        mc = ConvertBits(C(c, super1, vec), bits, fulls, False)
+        return mc.resize.Bicubic(clip.width, clip.height) if resized else mc
+    past = [Compensate(vectors.fvec[r - 1]) for r in range(radius, 0, -1)]
+    return core.std.Interleave(past + [clip] + (past[::-1] if causal else [Compensate(vectors.bvec[r - 1]) for r in range(1, radius + 1)]))
+
+# Interleaves each frame with its radius previous frames on both sides (mirrored), so that a temporal filter of that radius
+# reading the middle frame of each group only sees past frames
+def CausalWindow(clip: vs.VideoNode, radius: int) -> vs.VideoNode:
+    past = [ShiftFrames(clip, -r) for r in range(radius, 0, -1)]
+    return core.std.Interleave(past + [clip] + past[::-1])
 
 
 # BM3D denoising method
-def BM3D(clip: vs.VideoNode, ref: Optional[vs.VideoNode], sigma: float, gpuid: int, block_step: int, bm_range: int, ps_range: int, radius: int, bm3d_fast: bool) -> vs.VideoNode:
-    matrix = GetMatrix(clip)
-    fulls = GetColorRange(clip)
+def BM3D(clip: vs.VideoNode, ref: Optional[vs.VideoNode], sigma: float, gpuid: int, block_step: int, bm_range: int, ps_range: int, radius: int, bm3d_fast: bool, scenes: Optional[vs.VideoNode] = None) -> vs.VideoNode:
+    if scenes and radius > 0:
+        # Output frames aggregate blocks from frames up to 2 * radius away
+        return SceneGate([BM3D(clip, ref, sigma, gpuid, block_step, bm_range, ps_range, r, bm3d_fast) for r in range(radius + 1)], scenes, 2)
+    if ClipSampling(clip) in ["420", "422"]:
+        # Subsampled chroma: denoise each plane at its native size
+        planes = [BM3D(core.std.ShufflePlanes(clip, i, vs.GRAY), core.std.ShufflePlanes(ref, i, vs.GRAY) if ref else None,
+            sigma, gpuid, block_step, bm_range, ps_range, radius, bm3d_fast) for i in range(3)]
+        return core.std.ShufflePlanes(planes, [0, 0, 0], vs.YUV)
     chroma = clip.format.color_family==vs.YUV
     icalc = clip.format.bits_per_sample < 32
     if gpuid >= 0:
@@ -427,11 +1179,20 @@ def BM3D(clip: vs.VideoNode, ref: Optional[vs.VideoNode], sigma: float, gpuid: i
 
 
 # KnlMeansCL denoising method, useful for dark noisy scenes
-def KnlMeans(clip: vs.VideoNode, ref: Optional[vs.VideoNode], d: int, a: int, h: float, gpuid: int) -> vs.VideoNode:
+def KnlMeans(clip: vs.VideoNode, ref: Optional[vs.VideoNode], d: int, a: int, h: float, gpuid: int, info: Optional[ClipInfo] = None, scenes: Optional[vs.VideoNode] = None, vectors: Optional[MotionVectors] = None, causal: bool = False) -> vs.VideoNode:
+    if vectors and d > 0:
+        d = min(d, len(vectors.fvec))
+        window = lambda c: CompensatedWindow(c, vectors, d, (info or GetClipInfo(clip)).fulls, causal) if c else None
+        return KnlMeans(window(clip), window(ref), d, a, h, gpuid, info).std.SelectEvery(d * 2 + 1, d)
+    if scenes and d > 0:
+        return SceneGate([KnlMeans(clip, ref, r, a, h, gpuid, info, causal=causal) for r in range(d + 1)], scenes, causal=causal)
+    if causal and d > 0:
+        window = lambda c: CausalWindow(c, d) if c else None
+        return KnlMeans(window(clip), window(ref), d, a, h, gpuid, info).std.SelectEvery(d * 2 + 1, d)
     #if ref and ref.format != clip.format:
     #    ref = ref.resize.Bicubic(format=clip.format)
     bd = clip.format.bits_per_sample
-    fulls = GetColorRange(clip) == 0
+    fulls = (info or GetClipInfo(clip)).fulls
     if ref and ref.format.bits_per_sample != bd:
         ref = ConvertBits(ref, bd, fulls, True)
     src = clip
@@ -450,8 +1211,8 @@ def KnlMeans(clip: vs.VideoNode, ref: Optional[vs.VideoNode], d: int, a: int, h:
 
 
 # Adjusts brightness and contrast
-def Tweak(clip: vs.VideoNode, bright: float = None, cont: float = None) -> vs.VideoNode:
-    fulls = GetColorRange(clip) == 0
+def Tweak(clip: vs.VideoNode, bright: float = None, cont: float = None, fulls: Optional[bool] = None) -> vs.VideoNode:
+    fulls = fulls if fulls != None else GetColorRange(clip) == 0
     bd = clip.format.bits_per_sample
     isFLOAT = clip.format.sample_type == vs.FLOAT
     isGRAY = clip.format.color_family == vs.GRAY
@@ -468,16 +1229,30 @@ def Tweak(clip: vs.VideoNode, bright: float = None, cont: float = None) -> vs.Vi
             expr = "x {} * {} + 0.0 max 1.0 min".format(cont, bright)
             clip =  core.std.Expr([clip], [expr] if isGRAY else [expr, ''])
         else:
-            luma_lut = []
-            luma_min = 16  << (bd - 8) if not fulls else 0
-            luma_max = 235 << (bd - 8) if not fulls else (1 << bd) - 1
+            clip = core.std.Lut(clip, [0], list(TweakLut(bd, fulls, bright, cont)))
+    return clip
 
-            for i in range(1 << bd):
-                val = int((i - luma_min) * cont + bright + luma_min + 0.5)
-                luma_lut.append(min(max(val, luma_min), luma_max))
 
-            clip = core.std.Lut(clip, [0], luma_lut)
-    return clip
+# Tweak luma LUT, cached across calls. For positive contrast the curve is monotonic, so the clamped ends
+# are located by binary search and filled in bulk; only the linear segment is evaluated per entry.
+@functools.lru_cache(maxsize=None)
+def TweakLut(bd: int, fulls: bool, bright: float, cont: float) -> tuple:
+    luma_min = 16  << (bd - 8) if not fulls else 0
+    luma_max = 235 << (bd - 8) if not fulls else (1 << bd) - 1
+    size = 1 << bd
+    val = lambda i: int((i - luma_min) * cont + bright + luma_min + 0.5)
+    if cont <= 0:
+        return tuple(min(max(val(i), luma_min), luma_max) for i in range(size))
+
+    def first(cond):
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            lo, hi = (lo, mid) if cond(val(mid)) else (mid + 1, hi)
+        return lo
+    lo = first(lambda v: v > luma_min)
+    hi = max(lo, first(lambda v: v >= luma_max))
+    return (luma_min,) * lo + tuple(val(i) for i in range(lo, hi)) + (luma_max,) * (size - hi)
 
 
 # from muvsfunc
@@ -511,6 +1286,121 @@ def Sharpen(clip: vs.VideoNode, amountH: float = 1.0, amountV: Optional[float] =
     return clip
 
 
+# On-disk frame cache. Frames already stored in path are read back instead of rendering clip, others are rendered and stored.
+# Each frame file holds the planes and the frame props; props that can't be pickled (clips, frames, functions) are dropped.
+# With keys (see WindowHash), each frame is stored along with the hash of the source frames it was rendered from, and is only
+# read back when they still match, so that edits to part of the source render the affected frames again.
+def Checkpoint(clip: vs.VideoNode, path: str, keys: Optional[vs.VideoNode] = None) -> vs.VideoNode:
+    os.makedirs(path, exist_ok=True)
+    FramePath = lambda n: os.path.join(path, f"{n:08d}.bin")
+    KeyPath = lambda n: os.path.join(path, f"{n:08d}.key")
+
+    def StoredKey(n: int) -> Optional[str]:
+        try:
+            with open(KeyPath(n)) as src:
+                return src.read()
+        except OSError:
+            return None
+
+    def Save(n, f):
+        if not os.path.exists(FramePath(n)):
+            WriteFrame(f, FramePath(n))
+        return f
+
+    def SaveKeyed(n, f):
+        key = str(f[1].props["xClean_window"])
+        if StoredKey(n) != key:
+            # The key is removed first and written last, so that a frame is never read back with the key of another render
+            if os.path.exists(KeyPath(n)):
+                os.remove(KeyPath(n))
+            WriteFrame(f[0], FramePath(n))
+            WriteText(key, KeyPath(n))
+        return f[0]
+
+    def Load(n, f):
+        return ReadFrame(f, FramePath(n))
+
+    template = core.std.BlankClip(clip, keep=True)
+    reader = core.std.ModifyFrame(template, template, Load)
+    if not keys:
+        writer = core.std.ModifyFrame(clip, clip, Save)
+        return core.std.FrameEval(template, lambda n: reader if os.path.exists(FramePath(n)) else writer, clip_src=[reader, writer])
+    writer = core.std.ModifyFrame(clip, [clip, keys], SaveKeyed)
+    return core.std.FrameEval(template, lambda n, f: reader if StoredKey(n) == str(f.props["xClean_window"]) else writer,
+        prop_src=keys, clip_src=[reader, writer])
+
+# Small clip carrying an xClean_window prop per frame, a hash of the pixels of frames n-reach .. n+reach of clip
+def WindowHash(clip: vs.VideoNode, reach: int) -> vs.VideoNode:
+    def Hash(n, f):
+        h = hashlib.sha1()
+        for p in range(f.format.num_planes):
+            h.update(PlaneBytes(f, p))
+        fout = f.copy()
+        fout.props["xClean_hash"] = int.from_bytes(h.digest()[:8], "little", signed=True)
+        return fout
+    hashes = core.std.ModifyFrame(clip, clip, Hash)
+    def Combine(n, f):
+        fout = f[0].copy()
+        window = [p.props["xClean_hash"] for p in f]
+        fout.props["xClean_window"] = int.from_bytes(hashlib.sha1(repr(window).encode()).digest()[:8], "little", signed=True)
+        return fout
+    return core.std.ModifyFrame(hashes, [ShiftFrames(hashes, k) for k in range(-reach, reach + 1)], Combine)
+
+def WriteText(text: str, path: str):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w") as out:
+        out.write(text)
+    os.replace(tmp, path)
+
+def WriteFrame(f: vs.VideoFrame, path: str):
+    props = {}
+    for k, v in f.props.items():
+        try:
+            pickle.dumps(v)
+            props[k] = v
+        except Exception:
+            pass
+    planes = [PlaneBytes(f, p) for p in range(f.format.num_planes)]
+    # Written under a temporary name, so that concurrent renders never read a partial frame
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "wb") as out:
+        out.write(zlib.compress(pickle.dumps((props, planes)), 1))
+    os.replace(tmp, path)
+
+def ReadFrame(f: vs.VideoFrame, path: str) -> vs.VideoFrame:
+    with open(path, "rb") as src:
+        props, planes = pickle.loads(zlib.decompress(src.read()))
+    fout = f.copy()
+    fout.props.clear()
+    fout.props.update(props)
+    for p, data in enumerate(planes):
+        row = PlaneRowSize(fout, p)
+        ptr, stride = fout.get_write_ptr(p).value, fout.get_stride(p)
+        for y in range(len(data) // row):
+            ctypes.memmove(ptr + y * stride, data[y * row:(y + 1) * row], row)
+    return fout
+
+# Plane pixels without stride padding
+def PlaneBytes(f: vs.VideoFrame, p: int) -> bytes:
+    row = PlaneRowSize(f, p)
+    ptr, stride = f.get_read_ptr(p).value, f.get_stride(p)
+    height = f.height >> (f.format.subsampling_h if p else 0)
+    return b"".join(ctypes.string_at(ptr + y * stride, row) for y in range(height))
+
+def PlaneRowSize(f: vs.VideoFrame, p: int) -> int:
+    return (f.width >> (f.format.subsampling_w if p else 0)) * f.format.bytes_per_sample
+
+# Content hash of a clip from its format, length and a few sampled frames, plus any settings. Identifies a store,
+# Checkpoint checks each frame's source window on its own
+def Fingerprint(clip: vs.VideoNode, *params) -> str:
+    h = hashlib.sha1(repr((clip.width, clip.height, clip.num_frames, clip.format.id, clip.fps, params)).encode())
+    for n in sorted({0, clip.num_frames // 2, clip.num_frames - 1}):
+        f = clip.get_frame(n)
+        for p in range(f.format.num_planes):
+            h.update(PlaneBytes(f, p))
+    return h.hexdigest()[:16]
+
+
 # Point resize is 1.5x faster than fmtc
 def ConvertBits(c: vs.VideoNode, bits: int = 8, fulls: bool = False, dither: bool = False):
     if c.format.bits_per_sample == bits:
@@ -537,28 +1427,25 @@ def ClipSampling(clip: vs.VideoNode) -> str:
 
 # Get frame properties
 def GetFrameProp(c: vs.VideoNode, name: str, default):
-    props = c.get_frame(0).props
+    return GetProp(c.get_frame(0).props, name, default)
+
+def GetProp(props: vs.FrameProps, name: str, default):
     return props[name] if name in props else default
 
 def GetColorRange(c: vs.VideoNode) -> int:
-    return 0 if c.format.color_family == vs.RGB else GetFrameProp(c, "_ColorRange", 1)
+    return 0 if GetClipInfo(c).fulls else 1
 
 def GetMatrix(c: vs.VideoNode) -> int:
-    if c.format.color_family == vs.RGB:
-        return 0
-    matrix = GetFrameProp(c, "_Matrix", 1)
-    return 6 if matrix in [0, 2] else matrix
+    return GetClipInfo(c).matrix
 
 def GetTransfer(c: vs.VideoNode) -> int:
-    transfer = GetFrameProp(c, "_Transfer", 0)
-    return GetMatrix(c) if transfer in [0, 2] else transfer
+    return GetClipInfo(c).transfer
 
 def GetPrimaries(c: vs.VideoNode) -> int:
-    primaries = GetFrameProp(c, "_Primaries", 0)
-    return GetMatrix(c) if primaries in [0, 2] else primaries
+    return GetClipInfo(c).primaries
 
 def GetChromaLoc(c: vs.VideoNode) -> int:
-    return GetFrameProp(c, "_ChromaLocation", 0)
+    return GetClipInfo(c).chromaloc
 
 
 # Converts matrix into desired format. If matrix is not specified, it will read matrix from source frame property.
@@ -574,84 +1461,130 @@ def ConvertMatrix(c: vs.VideoNode, col_fam: int, fulls: bool, matrix: Optional[i
         return c.fmtc.matrix(csp=csp, mat=mat, fulls=fulls, fulld=fulls)
 
 
+# Kr, Kb coefficients of the YUV matrices that can be expressed as a single 3x3 matrix
+YUV_COEFS = {1: (.2126, .0722), 4: (.3, .11), 5: (.299, .114), 6: (.299, .114), 7: (.212, .087), 9: (.2627, .0593)}
+
+
+# Affine transform (m, b) from colorspace csp to RGB, working on native pixel values at given bit depth and range.
+def CspToRGB(csp: str, bits: int, fulls: bool, matrix: int = 1):
+    if csp == "RGB":
+        return [[1., 0., 0.], [0., 1., 0.], [0., 0., 1.]], [0., 0., 0.]
+    if csp == "YUV":
+        ymin, yrange, crange, half = \
+            (0., 1., 1., 0.) if bits == 32 else \
+            (0., (1 << bits) - 1., (1 << bits) - 1., float(1 << (bits - 1))) if fulls else \
+            (16. * (1 << (bits - 8)), 219. * (1 << (bits - 8)), 224. * (1 << (bits - 8)), 128. * (1 << (bits - 8)))
+        if matrix == 8:
+            m = [[1., -1., 1.], [1., 1., 0.], [1., -1., -1.]] # Y, Cg, Co
+        else:
+            kr, kb = YUV_COEFS[matrix]
+            kg = 1 - kr - kb
+            m = [[1., 0., 2 * (1 - kr)], [1., -2 * kb * (1 - kb) / kg, -2 * kr * (1 - kr) / kg], [1., 2 * (1 - kb), 0.]]
+        m = [[r[0], r[1] * yrange / crange, r[2] * yrange / crange] for r in m]
+        return AffineCompose((m, [ymin] * 3), ([[1., 0., 0.], [0., 1., 0.], [0., 0., 1.]], [-ymin, -half, -half]))
+    # YCgCoR and OPP are defined by their forward transform from RGB
+    return AffineInverse(*RGBToCsp(csp, bits, fulls))
+
+
+# Affine transform (m, b) from RGB to YCgCoR or OPP, matching the original per-plane expressions.
+def RGBToCsp(csp: str, bits: int, fulls: bool):
+    if csp == "YCgCoR":
+        h = float(ex_dlut("range_half", bits, fulls))
+        return [[.125, .5, .375], [-.125, .5, -.375], [.5, 0., -.5]], [0., h, h]
+    if csp == "OPP":
+        h = 0. if bits == 32 else float(ex_dlut("range_half", bits, fulls))
+        return [[1/3, 1/3, 1/3], [.5, 0., -.5], [.25, -.5, .25]], [0., h, h]
+    raise ValueError(f"RGBToCsp: colorspace {csp} is not supported.")
+
+
+# Returns a o b, the affine transform applying b then a
+def AffineCompose(a, b):
+    m = [[sum(a[0][i][k] * b[0][k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+    o = [sum(a[0][i][k] * b[1][k] for k in range(3)) + a[1][i] for i in range(3)]
+    return m, o
+
+
+def AffineInverse(m, b):
+    det = m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1]) - m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) + m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0])
+    inv = [[(m[(j+1)%3][(i+1)%3] * m[(j+2)%3][(i+2)%3] - m[(j+1)%3][(i+2)%3] * m[(j+2)%3][(i+1)%3]) / det for j in range(3)] for i in range(3)]
+    return inv, [-sum(inv[i][k] * b[k] for k in range(3)) for i in range(3)]
+
+
+# Expr for each row of the affine transform (m, b), applied to the operands (x, y, z by default)
+def AffineExpr(m, b, operands="xyz") -> list:
+    expr = []
+    for row, offset in zip(m, b):
+        terms = [f"{v} {k:.10f} *" for v, k in zip(operands, row) if abs(k) > 1e-9]
+        expr.append(" ".join(terms[:1] + [t + " +" for t in terms[1:]]) + (f" {offset:.10f} +" if abs(offset) > 1e-9 else ""))
+    return expr
+
+
+# Converts between RGB, YUV, YCgCoR and OPP in a single Expr pass by composing the whole chain into one 3x3 matrix.
+# Each output plane reads the 3 input planes through rotated ShufflePlanes views (x = same plane, y = next, z = next next).
+# Integer output matches the chain through RGB within 1 LSB, including out-of-gamut pixels, since RGB is still clamped in between.
+def ConvertColorspace(c: vs.VideoNode, src: str, dst: str, fulls: bool, matrix: Optional[int] = None) -> vs.VideoNode:
+    if src == dst:
+        return c
+    if ClipSampling(c) not in ["444", "RGB"]:
+        raise TypeError("ConvertColorspace: Clip must be YUV444 or RGB!")
+    if "YUV" in [src, dst]:
+        matrix = matrix if matrix != None else GetMatrix(c)
+    else:
+        matrix = 1 # Not used
+    if "YUV" in [src, dst] and matrix != 8 and not matrix in YUV_COEFS:
+        # Constant-luminance matrices are not linear, go through fmtc for the YUV side
+        if src == "YUV":
+            return ConvertColorspace(ConvertMatrix(c, vs.RGB, fulls, matrix), "RGB", dst, fulls)
+        return ConvertMatrix(ConvertColorspace(c, src, "RGB", fulls), vs.YUV, fulls, matrix)
+
+    bits = c.format.bits_per_sample
+    fam = c.format.color_family
+    planes = [c, core.std.ShufflePlanes(c, [1, 2, 0], fam), core.std.ShufflePlanes(c, [2, 0, 1], fam)]
+    if bits < 32 and "RGB" not in [src, dst]:
+        # Integer chains through RGB clipped out-of-gamut pixels there, keep that clamp between the two matrices
+        a, ab = CspToRGB(src, bits, fulls, matrix)
+        m, b = AffineInverse(*CspToRGB(dst, bits, fulls, matrix))
+        rgb = [AffineExpr([[a[k][(i+j)%3] for j in range(3)] for k in range(3)], ab) for i in range(3)]
+        expr = [AffineExpr([m[i]], [b[i]], [f"{r} 0 max {(1 << bits) - 1} min" for r in rgb[i]])[0] for i in range(3)]
+    else:
+        m, b = AffineCompose(AffineInverse(*CspToRGB(dst, bits, fulls, matrix)), CspToRGB(src, bits, fulls, matrix))
+        expr = [AffineExpr([[m[i][(i+j)%3] for j in range(3)]], [b[i]])[0] for i in range(3)]
+    output = core.std.Expr(planes, expr, format=GetFormat(vs.RGB if dst == "RGB" else vs.YUV, bits))
+    return output.std.SetFrameProp(prop='_Matrix', intval=0 if dst == "RGB" else matrix if dst == "YUV" else 2)
+
+
 # RGB to YCgCo RCT function
 def RGB_to_YCgCoR (c: vs.VideoNode, fulls: bool = False) -> vs.VideoNode:
     if c.format.color_family != vs.RGB:
         raise TypeError("RGB_to_YCgCoR: Clip is not in RGB format!")
-
-    bd = c.format.bits_per_sample
-    R = core.std.ShufflePlanes(c, [0], vs.GRAY)
-    G = core.std.ShufflePlanes(c, [1], vs.GRAY)
-    B = core.std.ShufflePlanes(c, [2], vs.GRAY)
-
-    Co = core.std.Expr([R,      B], ex_dlut("x 0.5  * y 0.5  * - range_half +",                bd, fulls))
-    Cg = core.std.Expr([Co, G,  B], ex_dlut("y z x range_half - 0.5 * + - 0.5 * range_half +", bd, fulls))
-    Y  = core.std.Expr([Co, Cg, B], ex_dlut("z x range_half - 0.5 * + y range_half - +",       bd, fulls))
-
-    output = core.std.ShufflePlanes([Y, Cg, Co], [0, 0, 0], vs.YUV)
-    return output.std.SetFrameProp(prop='_Matrix', intval=2)
+    return ConvertColorspace(c, "RGB", "YCgCoR", fulls)
 
 
 #  YCgCo RCT to RGB function
 def YCgCoR_to_RGB (c: vs.VideoNode, fulls: bool = False) -> vs.VideoNode:
     if c.format.color_family != vs.YUV:
         raise TypeError("YCgCoR_to_RGB: Clip is not in YUV format!")
-
-    bd = c.format.bits_per_sample
-    Y = core.std.ShufflePlanes(c, [0], vs.GRAY)
-    Cg = core.std.ShufflePlanes(c, [1], vs.GRAY)
-    Co = core.std.ShufflePlanes(c, [2], vs.GRAY)
-
-    G = core.akarin.Expr([Y, Cg    ], ex_dlut("y range_half - dup yvar! 2 * x yvar@ - +",             bd, fulls))
-    B = core.std.Expr([Y, Cg, Co], ex_dlut("x y range_half - - z range_half - 0.5 * -", bd, fulls))
-    R = core.std.Expr([Co, B    ], ex_dlut("y x range_half - 2 * +",                    bd, fulls))
-
-    output = core.std.ShufflePlanes([R, G, B], [0, 0, 0], vs.RGB)
-    return output.std.SetFrameProp(prop='_Matrix', intval=0)
+    return ConvertColorspace(c, "YCgCoR", "RGB", fulls)
 
 
 def RGB_to_OPP (c: vs.VideoNode, fulls: bool = False) -> vs.VideoNode:
     if c.format.color_family != vs.RGB:
-        raise TypeError("RGB_to_YCgCoR: Clip is not in RGB format!")
-
-    bd = c.format.bits_per_sample
-    R = core.std.ShufflePlanes(c, [0], vs.GRAY)
-    G = core.std.ShufflePlanes(c, [1], vs.GRAY)
-    B = core.std.ShufflePlanes(c, [2], vs.GRAY)
-
-    b32 = "" if bd == 32 else "range_half +"
-
-    O  = core.std.Expr([R, G, B], ex_dlut("x y z + + 0.333333333 *",     bd, fulls))
-    P1 = core.std.Expr([R,    B], ex_dlut("x y - 0.5 * "+b32,            bd, fulls))
-    P2 = core.std.Expr([R, G, B], ex_dlut("x z + 0.25 * y 0.5 * - "+b32, bd, fulls))
-
-    output = core.std.ShufflePlanes([O, P1, P2], [0, 0, 0], vs.YUV)
-    return output.std.SetFrameProp(prop='_Matrix', intval=2)
+        raise TypeError("RGB_to_OPP: Clip is not in RGB format!")
+    return ConvertColorspace(c, "RGB", "OPP", fulls)
 
 
 def OPP_to_RGB (c: vs.VideoNode, fulls: bool = False):
     if c.format.color_family != vs.YUV:
-        raise TypeError("YCgCoR_to_RGB: Clip is not in YUV format!")
-
-    bd = c.format.bits_per_sample
-    O = core.std.ShufflePlanes(c, [0], vs.GRAY)
-    P1 = core.std.ShufflePlanes(c, [1], vs.GRAY)
-    P2 = core.std.ShufflePlanes(c, [2], vs.GRAY)
-
-    b32 = "" if bd == 32 else "range_half -"
-
-    R = core.std.Expr([O, P1, P2], ex_dlut("x y "+b32+" + z "+b32+" 0.666666666 * +", bd, fulls))
-    G = core.std.Expr([O,     P2], ex_dlut("x y "+b32+" 1.333333333 * -",             bd, fulls))
-    B = core.std.Expr([O, P1, P2], ex_dlut("x z "+b32+" 0.666666666 * + y "+b32+" -", bd, fulls))
-
-    output = core.std.ShufflePlanes([R, G, B], [0, 0, 0], vs.RGB)
-    return output.std.SetFrameProp(prop='_Matrix', intval=0)
+        raise TypeError("OPP_to_RGB: Clip is not in YUV format!")
+    return ConvertColorspace(c, "OPP", "RGB", fulls)
 
 
 # HBD constants 3D look up table
 #
 # * YUV and RGB mid-grey is 127.5 (rounded to 128) for PC range levels,
 #   this translates to a value of 125.5 in TV range levels. Chroma is always centered, so 128 regardless.
+# * Expanded expressions are cached, repeated calls with the same arguments cost a dictionary lookup.
+@functools.lru_cache(maxsize=None)
 def ex_dlut(expr: str = "", bits: int = 8, fulls: bool = False) -> str:
     bitd = \
         0 if bits == 8 else \
@@ -701,8 +1634,8 @@ def ex_dlut(expr: str = "", bits: int = 8, fulls: bool = False) -> str:
 
 
 # feisty2's ChromaReconstructor_faster v3.0 HBD mod by DogWay
-def ChromaReconstructor(clip: vs.VideoNode, gpuid: int = 0):
-    fulls = GetColorRange(clip) == 0
+def ChromaReconstructor(clip: vs.VideoNode, gpuid: int = 0, fulls: Optional[bool] = None):
+    fulls = fulls if fulls != None else GetColorRange(clip) == 0
     w = clip.width
     h = clip.height
     Y = core.std.ShufflePlanes(clip, [0], vs.GRAY)
@@ -0,0 +1,212 @@
+from vapoursynth import core
+import vapoursynth as vs
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Optional
+
+"""
+xClean benchmark
+Measures xClean throughput on synthetic noisy clips over a matrix of configurations.
+Requires: everything xClean requires, plus grain (AddGrain)
+
+Each configuration runs in its own process so that peak RSS is measured per configuration.
+Results are reported as JSON: fps, graph build time, peak RSS and node count (when the VapourSynth build supports graph inspection).
+
+Usage:
+python xClean_bench.py --res 720p 1080p --sampling 420 --m1 0 .6 --m2 0 2 --frames 30 --output bench.json
+python xClean_bench.py --baseline bench.json --tolerance .1    (exits with code 1 if any configuration is slower than the baseline by more than 10%)
+python xClean_bench.py --fused-check --res 480p 1080p    (exits with code 1 if fused post-processing differs from the unfused chain by more than 1 LSB)
+python xClean_bench.py --preset webcam    (causal mode on CPU at 720p, "realtime" tells whether it keeps up with the 30 fps clip)
+"""
+
+RESOLUTIONS = {"480p": (854, 480), "720p": (1280, 720), "1080p": (1920, 1080), "4K": (3840, 2160)}
+SAMPLINGS = {"GRAY": vs.GRAY8, "420": vs.YUV420P8, "RGB": vs.RGB24}
+FPS = 30
+
+# Configuration matrix axes and their default values. Every combination is benchmarked.
+AXES = {
+    "m1": [0, .6],
+    "m2": [0, 2, 3.6],
+    "m3": [0, 2],
+    "radius": [0],
+    "chroma": ["nnedi3", "bicubic", "native"],
+    "gpuid": [-1],
+}
+
+# Named sets of defaults, options given on the command line override them. settings are passed to every configuration.
+PRESETS = {
+    "webcam": {"res": ["720p"], "sampling": ["420"], "m1": [.6, 2], "m2": [0], "m3": [0, 2], "gpuid": [-1], "settings": {"causal": True}},
+}
+
+
+# Synthetic noisy clip: a smooth gradient with seeded grain, so that every run renders identical frames
+def NoisyClip(width: int, height: int, sampling: str = "420", frames: int = 60, seed: int = 1, var: float = 20) -> vs.VideoNode:
+    fmt = SAMPLINGS[sampling]
+    clip = core.std.BlankClip(width=width, height=height, format=fmt, length=frames, fpsnum=FPS, fpsden=1)
+    clip = core.akarin.Expr(clip, "X width / 160 * Y height / 60 * + 16 +" if fmt != vs.RGB24 else "X width / 200 * 30 +")
+    clip = clip.grain.Add(var=var, uvar=var/2 if fmt == vs.YUV420P8 else var if fmt == vs.RGB24 else 0, seed=seed, constant=False)
+    if fmt != vs.RGB24:
+        clip = clip.std.SetFrameProps(_ColorRange=1, _Matrix=1, _Transfer=1, _Primaries=1, _ChromaLocation=0)
+    return clip
+
+
+# Number of nodes in the graph, or None if this VapourSynth build does not expose graph inspection
+def CountNodes(node: vs.VideoNode) -> Optional[int]:
+    if not hasattr(node, "_dependencies"):
+        return None
+    seen = {}
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if id(n) in seen:
+            continue
+        seen[id(n)] = n
+        stack.extend(n._dependencies)
+    return len(seen)
+
+
+def PeakRSS() -> float:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs one configuration. Called in a fresh process.
+def RunConfig(res: str, sampling: str, frames: int, warmup: int, config: dict) -> dict:
+    import xClean as x
+    introspect = getattr(vs, "_try_enable_introspection", None)
+    if introspect:
+        introspect()
+    width, height = RESOLUTIONS[res]
+    clip = NoisyClip(width, height, sampling, frames + warmup)
+
+    start = time.perf_counter()
+    output = x.xClean(clip, **config)
+    build = time.perf_counter() - start
+
+    for f in output[:warmup].frames(prefetch=core.num_threads):
+        pass
+    start = time.perf_counter()
+    for f in output[warmup:].frames(prefetch=core.num_threads):
+        pass
+    elapsed = time.perf_counter() - start
+
+    return {
+        "res": res,
+        "sampling": sampling,
+        "config": config,
+        "frames": frames,
+        "fps": frames / elapsed,
+        "realtime": frames / elapsed >= FPS,
+        "build_ms": build * 1000,
+        "peak_rss_mb": PeakRSS(),
+        "nodes": CountNodes(output),
+    }
+
+
+# Runs every combination of resolutions, samplings and axes values, each in its own process
+def Benchmark(resolutions: list, samplings: list, axes: dict = AXES, frames: int = 30, warmup: int = 5, settings: dict = {}) -> list:
+    configs = [dict(settings, **dict(zip(axes.keys(), values))) for values in itertools.product(*axes.values())]
+    # A configuration with every pass disabled is invalid
+    configs = [c for c in configs if c.get("m1", 1) or c.get("m2", 1) or c.get("m3", 1)]
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for res, sampling, config in itertools.product(resolutions, samplings, configs):
+        # Chroma upsampling only runs on subsampled clips, other samplings need one chroma mode
+        if sampling in ["GRAY", "RGB"] and config.get("chroma", axes.get("chroma", [None])[0]) != axes.get("chroma", [None])[0]:
+            continue
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            try:
+                result = pool.apply(RunConfig, (res, sampling, frames, warmup, config))
+            except Exception as e:
+                result = {"res": res, "sampling": sampling, "config": config, "error": str(e)}
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+# Post-processing settings compared by FusedCheck, for each method
+FUSED_CASES = [dict(sharp=9.5, rn=14), dict(sharp=0, rn=14), dict(sharp=9.5, rn=0), dict(sharp=20, rn=20), dict(sharp=9.5, rn=14, strength=-50)]
+
+# Largest luma difference (in LSB at 16-bit) between fused and unfused post-processing over the frames, for each method and case.
+# A border pixels wide band is skipped, fused kernels read mirrored edges there.
+def FusedCheck(res: str, sampling: str, frames: int = 10, border: int = 4) -> list:
+    import xClean as x
+    width, height = RESOLUTIONS[res]
+    clip = NoisyClip(width, height, sampling, frames)
+    c = clip.resize.Point(format=vs.GRAY16) if sampling == "GRAY" else clip.resize.Bicubic(format=vs.YUV444P16, matrix_in_s="709", matrix_s="709")
+    clean = c.std.BoxBlur(hradius=2, vradius=2) # Stand-in for a denoising pass
+    results = []
+    for method, case in itertools.product([0, 1, 2], FUSED_CASES):
+        case = dict(dict(strength=20), **case)
+        pp = lambda fused: x.PostProcessing(clean, c, height, case["strength"], case["sharp"], case["rn"], 18, method, fused=fused)
+        diff = core.std.Expr([pp(False), pp(True)], "x y - abs", format=vs.GRAY16 if sampling == "GRAY" else None)
+        diff = diff.std.Crop(border, border, border, border).std.PlaneStats()
+        worst = max(f.props["PlaneStatsMax"] for f in diff.frames(prefetch=core.num_threads))
+        results.append({"res": res, "sampling": sampling, "method": method, "case": case, "max_diff": worst})
+    return results
+
+
+# Returns the results whose fps dropped by more than tolerance compared to the matching baseline entry
+def Regressions(results: list, baseline: list, tolerance: float = .1) -> list:
+    key = lambda r: (r["res"], r["sampling"], json.dumps(r["config"], sort_keys=True))
+    base = {key(r): r for r in baseline if "fps" in r}
+    return [dict(r, baseline_fps=base[key(r)]["fps"]) for r in results
+            if "fps" in r and key(r) in base and r["fps"] < base[key(r)]["fps"] * (1 - tolerance)]
+
+
+def ParseValue(v: str):
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="xClean benchmark")
+    parser.add_argument("--res", nargs="+", default=["720p"], choices=RESOLUTIONS.keys())
+    parser.add_argument("--sampling", nargs="+", default=["420"], choices=SAMPLINGS.keys())
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results from a previous run")
+    parser.add_argument("--tolerance", type=float, default=.1)
+    parser.add_argument("--preset", choices=PRESETS.keys())
+    parser.add_argument("--fused-check", action="store_true", help="Compare fused and unfused post-processing instead of benchmarking")
+    for axis, default in AXES.items():
+        parser.add_argument("--" + axis, nargs="+", type=ParseValue, default=default)
+    parser.set_defaults(settings={})
+    args = parser.parse_args()
+    if args.preset:
+        parser.set_defaults(**PRESETS[args.preset])
+        args = parser.parse_args()
+
+    if args.fused_check:
+        results = [r for res, sampling in itertools.product(args.res, args.sampling) if sampling != "RGB" for r in FusedCheck(res, sampling, args.frames)]
+        print(json.dumps(results, indent=2))
+        failed = [r for r in results if r["max_diff"] > 1]
+        for r in failed:
+            print(f"Fused mismatch: {r['res']} {r['sampling']} method {r['method']} {r['case']}: {r['max_diff']} LSB", file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    results = Benchmark(args.res, args.sampling, {axis: getattr(args, axis) for axis in AXES}, args.frames, args.warmup, args.settings)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = Regressions(results, json.load(f), args.tolerance)
+        for r in slower:
+            print(f"Regression: {r['res']} {r['sampling']} {r['config']}: {r['fps']:.2f} fps (baseline {r['baseline_fps']:.2f})", file=sys.stderr)
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,457 @@
+from vapoursynth import core
+import vapoursynth as vs
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import runpy
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from typing import Callable, Optional, Union
+
+"""
+xClean chunked render driver
+Renders xClean over a process pool. The clip is split into frame ranges, and each range is padded with the temporal context
+that the active configuration needs (see xClean.TemporalReach), denoised in its own process, trimmed back and concatenated.
+Output is frame-identical to a serial render, as long as frame properties read by xClean (_ColorRange, _Matrix, _ChromaLocation)
+are constant over the clip.
+With scenecut, cuts are detected first and each split moves to the nearest cut within half a chunk. Temporal windows don't cross
+cuts, so ranges starting or ending at a cut need no padding.
+
+The source is either a VapourSynth script path, whose output 0 is the clip to denoise, or a picklable function returning the clip
+(a module-level function). It is loaded again in every worker process since clips cannot be shared between processes.
+
+Multi-node mode: a coordinator owns the queue of frame ranges and workers connect over TCP, pull a range, render it and stream
+it back zlib-compressed. Ranges held by a worker that disconnects or fails are put back in the queue, up to retries times.
+Messages are JSON lines, and rendered ranges are sent as length-prefixed compressed blocks ending with an empty block.
+While rendering, workers send a heartbeat every HEARTBEAT seconds. A worker silent for more than timeout seconds (60 by default)
+is considered dead, and TCP keepalive is enabled on both ends. A worker whose connection breaks reconnects for the next range.
+The source script path is sent to workers, so it must be reachable at the same path from every worker (or given with --source).
+Workers run whatever script and settings the coordinator sends, and there is no authentication: the coordinator listens on
+127.0.0.1 unless --host is given, only open it to a trusted network.
+
+Resumable renders (--resume): rendered ranges are kept as segment files in <output>.parts, and each completed range is appended to a
+journal there. Running the same command again skips the ranges in the journal; each remaining range is rendered with its padding
+frames, which primes the temporal context from the preceding frames. Segments are concatenated and removed once all are done.
+The journal is discarded if the source, chunk size or settings changed.
+
+Usage:
+python xClean_render.py source.vpy output.y4m --workers 8 --chunk 300 --y4m -- m1=.6 m2=3.8 sharp=7.7
+Render("source.vpy", "output.y4m", workers=8, y4m=True, m1=.6, m2=3.8)
+
+python xClean_render.py source.vpy output.y4m --listen 7200 --host 0.0.0.0 --local-workers 2 --y4m -- m1=.6    (coordinator)
+python xClean_render.py --worker coordinator-host:7200    (on each render node)
+"""
+
+
+# Loads the source clip from a script path or a function
+def LoadSource(source: Union[str, Callable[[], vs.VideoNode]]) -> vs.VideoNode:
+    if callable(source):
+        return source()
+    runpy.run_path(source, run_name="__vapoursynth__")
+    output = vs.get_output(0)
+    return output[0] if isinstance(output, vs.VideoOutputTuple) else output
+
+
+# Splits [0, num_frames) into ranges of about chunk frames, as (start, end, padding before, padding after).
+# Each split moves to the nearest cut within half a chunk if any, where cutpad frames of padding are enough.
+def Chunks(num_frames: int, chunk: int, reach: int = 0, cuts: Optional[list] = None, cutpad: int = 0) -> list:
+    cuts = sorted(cuts or [])
+    bounds = [0]
+    while bounds[-1] + chunk < num_frames:
+        target = bounds[-1] + chunk
+        near = [c for c in cuts if bounds[-1] + chunk // 2 < c <= target + chunk // 2 and c < num_frames]
+        bounds.append(min(near, key=lambda c: abs(c - target)) if near else target)
+    bounds.append(num_frames)
+    pad = lambda b: cutpad if b in cuts else reach
+    return [(start, end, pad(start), pad(end)) for start, end in zip(bounds, bounds[1:])]
+
+# Frame ranges for xClean(source, **kwargs), padded with the temporal context it needs
+def PlanChunks(source, chunk: int, kwargs: dict) -> list:
+    import xClean as x
+    clip = LoadSource(source)
+    cuts = None
+    if kwargs.get("scenecut"):
+        scenes = x.SceneChanges(clip, kwargs["scenecut"])
+        cuts = [n for n, f in enumerate(scenes.frames(prefetch=core.num_threads)) if n > 0 and f.props["_SceneChangePrev"]]
+    # Windows that aren't gated at cuts still need their context: the noise estimate averages 2 frames on each side (4 before with causal),
+    # and mvadapt averages motion stats of the delta 1 vectors over 2 frames on each side (4 before with causal), which read one more frame
+    causal = kwargs.get("causal")
+    cutpad = 0
+    if kwargs.get("bypass") or kwargs.get("bypassbm3d"):
+        cutpad = 4 if causal else 2
+    if kwargs.get("mvadapt") and kwargs.get("m1", .6) > 0:
+        cutpad = max(cutpad, 5 if causal else 3)
+    reach = x.TemporalReach(**kwargs)
+    # With mcomp, KNLMeans reads compensated neighbours across cuts, along with everything upstream of them
+    if kwargs.get("mcomp"):
+        cutpad = reach
+    return Chunks(clip.num_frames, chunk, reach, cuts, cutpad)
+
+
+# Denoises frames [start, end) of the source into path, with before and after frames of context. Called in a worker process.
+def RenderChunk(source, start: int, end: int, before: int, after: int, path: str, y4m: bool, threads: int, kwargs: dict) -> str:
+    import xClean as x
+    if threads:
+        core.num_threads = threads
+    clip = LoadSource(source)
+    first, last = max(0, start - before), min(clip.num_frames, end + after)
+    output = x.xClean(clip[first:last], **kwargs)[start - first:end - first]
+    with open(path, "wb") as f:
+        output.output(f, y4m=y4m)
+    return path
+
+
+# Appends a rendered chunk to the output. Y4M chunks after the first have their stream header line skipped.
+def AppendChunk(out, path: str, header: bool):
+    with open(path, "rb") as f:
+        if not header:
+            f.readline()
+        shutil.copyfileobj(f, out)
+
+
+# Rendered segment files and the journal of completed frame ranges
+class Journal:
+    def __init__(self, path: str, plan: list):
+        self.path = path
+        self.file = os.path.join(path, "journal.jsonl")
+        self.lock = threading.Lock()
+        self.done = {}
+        key = hashlib.sha1(json.dumps(plan, sort_keys=True, default=str).encode()).hexdigest()
+        os.makedirs(path, exist_ok=True)
+        lines = []
+        if os.path.exists(self.file):
+            with open(self.file) as f:
+                lines = [json.loads(line) for line in f if line.endswith("\n")] # The last line may be partial
+        if not lines or lines[0].get("plan") != key:
+            # New render, or a different one: start over
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            with open(self.file, "w") as f:
+                f.write(json.dumps({"plan": key}) + "\n")
+            lines = []
+        for line in lines[1:]:
+            job = tuple(line["job"])
+            if os.path.exists(self.Segment(job)) and os.path.getsize(self.Segment(job)) == line["size"]:
+                self.done[job] = self.Segment(job)
+
+    def Segment(self, job: tuple) -> str:
+        return os.path.join(self.path, f"{job[0]:08d}-{job[1]:08d}.bin")
+
+    # Moves a rendered range to its segment file and records it, flushed to disk before returning.
+    # The segment data and its directory entry reach the disk before the journal line that points to them.
+    def Complete(self, job: tuple, path: str):
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(path, self.Segment(job))
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self.lock, open(self.file, "a") as f:
+            f.write(json.dumps({"job": job, "size": os.path.getsize(self.Segment(job))}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            self.done[job] = self.Segment(job)
+
+    # Concatenates all segments in order into output
+    def Concatenate(self, output: str, chunks: list):
+        with open(output, "wb") as out:
+            for i, job in enumerate(chunks):
+                AppendChunk(out, self.done[job], i == 0)
+
+    def Remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# Identifies the source in the journal plan, with the content hash of the script (or of the module defining the callable),
+# so that segments rendered before the script was edited aren't reused
+def SourceName(source) -> str:
+    name = source if isinstance(source, str) else f"{source.__module__}.{source.__qualname__}"
+    path = source if isinstance(source, str) else getattr(sys.modules.get(source.__module__), "__file__", None)
+    if not path or not os.path.isfile(path):
+        return name
+    with open(path, "rb") as f:
+        return f"{name}@{hashlib.sha1(f.read()).hexdigest()[:16]}"
+
+
+# Renders xClean(source, **kwargs) to output, as raw planar frames or Y4M, using a pool of worker processes
+def Render(source, output: str, workers: Optional[int] = None, chunk: int = 300, y4m: bool = False, threads: Optional[int] = None, resume: bool = False, **kwargs) -> int:
+    if chunk < 1:
+        raise ValueError("xClean_render: chunk must be at least 1 frame")
+    workers = workers or os.cpu_count()
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    chunks = PlanChunks(source, chunk, kwargs)
+    parts = output + ".parts" if resume else tempfile.mkdtemp(prefix="xclean_", dir=os.path.dirname(os.path.abspath(output)))
+    journal = Journal(parts, [SourceName(source), chunks, y4m, kwargs])
+    jobs = [(source, *job, journal.Segment(job) + ".tmp", y4m, threads, kwargs) for job in chunks if job not in journal.done]
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(workers) as pool:
+            for job, path in pool.imap_unordered(Unpack, jobs):
+                journal.Complete(job, path)
+        journal.Concatenate(output, chunks)
+    except BaseException:
+        if not resume:
+            journal.Remove()
+        raise
+    journal.Remove()
+    return len(chunks)
+
+def Unpack(job: tuple) -> tuple:
+    return tuple(job[1:5]), RenderChunk(*job)
+
+
+# Sends a JSON message line
+# Seconds between worker heartbeats while a range renders
+HEARTBEAT = 5
+
+# Enables TCP keepalive, probing after idle seconds, so that a peer that vanished without closing the connection is detected
+def KeepAlive(sock: socket.socket, idle: int = 30):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, value in [("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", idle // 3), ("TCP_KEEPCNT", 3)]:
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+def Send(sock: socket.socket, msg: dict):
+    sock.sendall((json.dumps(msg) + "\n").encode())
+
+# Reads a JSON message line, or None if the connection was closed
+def Recv(f) -> Optional[dict]:
+    line = f.readline()
+    return json.loads(line) if line else None
+
+# Streams a file as zlib-compressed blocks, each prefixed with its length, ending with an empty block
+def SendFile(sock: socket.socket, path: str, block: int = 1 << 22):
+    z = zlib.compressobj(1)
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(block), b""):
+            data = z.compress(data)
+            if data:
+                sock.sendall(struct.pack(">I", len(data)) + data)
+    data = z.flush()
+    sock.sendall(struct.pack(">I", len(data)) + data + struct.pack(">I", 0))
+
+def RecvFile(f, path: str):
+    z = zlib.decompressobj()
+    with open(path, "wb") as out:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                raise ConnectionError("connection closed while receiving chunk")
+            size = struct.unpack(">I", head)[0]
+            if size == 0:
+                break
+            data = f.read(size)
+            if len(data) < size:
+                raise ConnectionError("connection closed while receiving chunk")
+            out.write(z.decompress(data))
+        out.write(z.flush())
+
+
+# Owns the frame range queue and hands ranges out to TCP workers
+class Coordinator:
+    def __init__(self, source: str, output: str, chunk: int = 300, y4m: bool = False, host: str = "127.0.0.1", port: int = 0, retries: int = 3, timeout: Optional[float] = 60, resume: bool = False, **kwargs):
+        if not isinstance(source, str):
+            raise ValueError("xClean_render: the coordinator source must be a script path")
+        if chunk < 1:
+            raise ValueError("xClean_render: chunk must be at least 1 frame")
+        self.source = source
+        self.output = output
+        self.y4m = y4m
+        self.retries = retries
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.chunks = PlanChunks(source, chunk, kwargs)
+        self.resume = resume
+        parts = output + ".parts" if resume else tempfile.mkdtemp(prefix="xclean_", dir=os.path.dirname(os.path.abspath(output)))
+        self.journal = Journal(parts, [SourceName(source), self.chunks, y4m, kwargs])
+        self.pending = collections.deque(job for job in self.chunks if job not in self.journal.done)
+        self.failures = collections.Counter()
+        self.error = None
+        self.cond = threading.Condition()
+        self.server = socket.create_server((host, port))
+        self.host = "127.0.0.1" if host in ["", "0.0.0.0"] else host
+        self.port = self.server.getsockname()[1]
+
+    # Serves workers until every range is rendered, then concatenates the output
+    def Run(self, local_workers: int = 0, threads: Optional[int] = None) -> int:
+        threading.Thread(target=self.Accept, daemon=True).start()
+        ctx = multiprocessing.get_context("spawn")
+        local = [ctx.Process(target=Work, args=(self.host, self.port, None, threads)) for _ in range(local_workers)]
+        for p in local:
+            p.start()
+        try:
+            with self.cond:
+                while len(self.journal.done) < len(self.chunks) and not self.error:
+                    self.cond.wait()
+            if self.error:
+                raise RuntimeError(self.error)
+            self.journal.Concatenate(self.output, self.chunks)
+            self.journal.Remove()
+        finally:
+            self.server.close()
+            for p in local:
+                p.join(5)
+                if p.is_alive():
+                    p.terminate()
+            if not self.resume:
+                self.journal.Remove()
+        return len(self.chunks)
+
+    def Accept(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                return # Server closed
+            # Applies to each read: workers send heartbeats while rendering, so it's the longest silence allowed
+            conn.settimeout(self.timeout)
+            KeepAlive(conn)
+            threading.Thread(target=self.Serve, args=(conn,), daemon=True).start()
+
+    # Hands out ranges to one worker connection until the queue is empty
+    def Serve(self, conn: socket.socket):
+        job = None
+        with conn, conn.makefile("rb") as f:
+            try:
+                while True:
+                    job = self.Next()
+                    if not job:
+                        Send(conn, {"type": "done"})
+                        return
+                    start, end, before, after = job
+                    Send(conn, {"type": "chunk", "source": self.source, "start": start, "end": end, "before": before, "after": after, "y4m": self.y4m, "kwargs": self.kwargs})
+                    msg = Recv(f)
+                    while msg and msg["type"] == "heartbeat":
+                        msg = Recv(f)
+                    if not msg:
+                        raise ConnectionError("worker disconnected")
+                    if msg["type"] == "error":
+                        self.Requeue(job, msg["message"])
+                        job = None
+                        continue
+                    path = f"{self.journal.Segment(job)}.{threading.get_ident()}.tmp"
+                    RecvFile(f, path)
+                    with self.cond:
+                        self.journal.Complete(job, path)
+                        self.cond.notify_all()
+                    job = None
+            except (OSError, ValueError, zlib.error) as e:
+                if job:
+                    self.Requeue(job, str(e))
+
+    # Next pending range. Waits while other workers still hold ranges that may come back to the queue.
+    def Next(self) -> Optional[tuple]:
+        with self.cond:
+            while not self.pending and len(self.journal.done) < len(self.chunks) and not self.error:
+                self.cond.wait()
+            return self.pending.popleft() if self.pending and not self.error else None
+
+    def Requeue(self, job: tuple, reason: str):
+        with self.cond:
+            self.failures[job] += 1
+            if self.failures[job] > self.retries:
+                self.error = f"xClean_render: frames {job[0]}-{job[1]} failed {self.failures[job]} times: {reason}"
+            else:
+                self.pending.appendleft(job)
+            self.cond.notify_all()
+
+
+# Worker loop: pulls ranges from the coordinator, renders and sends them back until told it's done.
+# source overrides the script path sent by the coordinator, when it lives at another path on this node.
+# When the connection breaks, the range is left to the coordinator to requeue and the worker connects again for the next one.
+def Work(host: str, port: int, source: Optional[str] = None, threads: Optional[int] = None):
+    while True:
+        try:
+            if WorkSession(host, port, source, threads):
+                return
+        except ConnectionRefusedError:
+            return # Coordinator is gone
+        except OSError as e:
+            print(f"xClean_render: connection lost ({e}), reconnecting", file=sys.stderr)
+
+# Serves one coordinator connection, returns True when the coordinator has no more ranges
+def WorkSession(host: str, port: int, source: Optional[str], threads: Optional[int]) -> bool:
+    with socket.create_connection((host, port)) as sock, sock.makefile("rb") as f:
+        KeepAlive(sock)
+        with tempfile.TemporaryDirectory(prefix="xclean_") as tmp:
+            while True:
+                msg = Recv(f)
+                if not msg or msg["type"] == "done":
+                    return bool(msg)
+                path = os.path.join(tmp, "chunk.bin")
+                stop = threading.Event()
+                def Heartbeat():
+                    while not stop.wait(HEARTBEAT):
+                        try:
+                            Send(sock, {"type": "heartbeat"})
+                        except OSError:
+                            return
+                heartbeat = threading.Thread(target=Heartbeat, daemon=True)
+                heartbeat.start()
+                try:
+                    RenderChunk(source or msg["source"], msg["start"], msg["end"], msg["before"], msg["after"], path, msg["y4m"], threads, msg["kwargs"])
+                except Exception as e:
+                    stop.set()
+                    heartbeat.join()
+                    Send(sock, {"type": "error", "message": f"{type(e).__name__}: {e}"})
+                    continue
+                stop.set()
+                heartbeat.join()
+                Send(sock, {"type": "result", "start": msg["start"]})
+                SendFile(sock, path)
+                os.remove(path)
+
+
+def ParseValue(v: str):
+    if v in ["True", "False"]:
+        return v == "True"
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="xClean chunked render driver")
+    parser.add_argument("source", nargs="?", help="VapourSynth script whose output 0 is the clip to denoise")
+    parser.add_argument("output", nargs="?", help="Output file, raw planar frames or Y4M with --y4m")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--listen", type=int, metavar="PORT", help="Run as coordinator for TCP workers on this port")
+    parser.add_argument("--host", default="127.0.0.1", help="Coordinator: address to listen on, 0.0.0.0 for every interface (workers are not authenticated)")
+    parser.add_argument("--local-workers", type=int, default=0, help="Coordinator: workers to start on this machine")
+    parser.add_argument("--retries", type=int, default=3, help="Coordinator: times a range is requeued after a worker failure")
+    parser.add_argument("--timeout", type=float, default=60, help="Coordinator: seconds without worker heartbeat before its range is requeued")
+    parser.add_argument("--worker", metavar="HOST:PORT", help="Run as worker for the coordinator at this address")
+    parser.add_argument("--threads", type=int, help="VapourSynth threads per worker (default: CPU count / workers)")
+    parser.add_argument("--chunk", type=int, default=300, help="Frames per chunk")
+    parser.add_argument("--y4m", action="store_true")
+    parser.add_argument("--resume", action="store_true", help="Keep segments and a journal in <output>.parts, and resume from them")
+    parser.add_argument("settings", nargs="*", help="xClean settings as name=value")
+    args = parser.parse_args()
+
+    if args.worker:
+        host, port = args.worker.rsplit(":", 1)
+        Work(host, int(port), args.source, args.threads)
+        sys.exit(0)
+    if not args.source or not args.output:
+        parser.error("source and output are required")
+
+    kwargs = {k: ParseValue(v) for k, v in (s.split("=", 1) for s in args.settings)}
+    if args.listen is not None:
+        coordinator = Coordinator(args.source, args.output, args.chunk, args.y4m, host=args.host, port=args.listen, retries=args.retries, timeout=args.timeout, resume=args.resume, **kwargs)
+        count = coordinator.Run(args.local_workers, args.threads)
+    else:
+        count = Render(args.source, args.output, args.workers, args.chunk, args.y4m, args.threads, args.resume, **kwargs)
+    print(f"Rendered {count} chunks to {args.output}", file=sys.stderr)
@@ -0,0 +1,98 @@
+from vapoursynth import core
+import vapoursynth as vs
+import itertools
+import os
+import sys
+from xClean_render import LoadSource, ParseValue
+
+"""
+xClean parameter sweep
+Renders sample frames of a source over a grid of xClean settings, to compare them side by side.
+Requires: everything xClean requires, plus imwri for image output
+
+Every configuration is built with the same shared dict (see xClean shared), so configurations that only differ
+in a late stage reuse the same upstream nodes: sweeping h over 5 values runs MVTools and BM3D once, not 5 times.
+Frames are requested frame by frame across all configurations, so each upstream frame is still in the cache
+when the next configuration needs it.
+
+Usage:
+python xClean_sweep.py source.vpy --frames 100 500 900 --stack compare.png h=1.4,2.8,4.2 m2=0,2 m1=.6
+python xClean_sweep.py source.vpy --frames 100 500 --output-dir sweep m3=2 d=1,2,3    (writes one image per configuration and frame)
+Each setting is name=value, with several comma separated values to sweep over them.
+"""
+
+
+# Builds one xClean node per combination of grid values, sharing nodes with identical upstream settings.
+# Returns a list of (settings, node)
+def Sweep(clip: vs.VideoNode, grid: dict, **kwargs) -> list:
+    import xClean as x
+    shared = {}
+    configs = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    sweep = [(config, x.xClean(clip, **kwargs, **config, shared=shared)) for config in configs]
+    stages = [key for key in shared if key[0] != "clip"]
+    print(f"{len(sweep)} configurations, {len(stages)} unique stages", file=sys.stderr)
+    return sweep
+
+
+# Settings of a configuration, as a label and as a file name
+def Label(config: dict) -> str:
+    return " ".join(f"{k}={v}" for k, v in config.items()) or "xClean"
+
+def FileName(config: dict) -> str:
+    return "_".join(f"{k}{v}" for k, v in config.items()) or "xClean"
+
+
+# 8 bit RGB (or GRAY) for image output and stacking, colorimetry is read from frame props
+def ToImage(c: vs.VideoNode) -> vs.VideoNode:
+    return c.resize.Bicubic(format=vs.GRAY8 if c.format.color_family == vs.GRAY else vs.RGB24, dither_type="error_diffusion")
+
+
+# A grid of the source and every configuration, labelled with their settings
+def ComparisonStack(clip: vs.VideoNode, sweep: list, columns: int = 0) -> vs.VideoNode:
+    tiles = [("source", clip)] + [(Label(config), node) for config, node in sweep]
+    tiles = [ToImage(node).text.Text(label) for label, node in tiles]
+    columns = columns or max(1, round(len(tiles) ** .5))
+    tiles += [tiles[0].std.BlankClip(keep=True)] * (-len(tiles) % columns)
+    rows = [core.std.StackHorizontal(tiles[i:i + columns]) for i in range(0, len(tiles), columns)]
+    return core.std.StackVertical(rows) if len(rows) > 1 else rows[0]
+
+
+# Writes the sample frames of every (path, node) as path_<frame>.png.
+# Frames are requested frame by frame across nodes, so that upstream frames shared between configurations are rendered once.
+def WriteImages(images: list, frames: list) -> None:
+    writes = [ToImage(node)[f].imwri.Write("PNG", path + "_%06d.png", firstnum=f, overwrite=True) for f in frames for path, node in images]
+    for f in core.std.Splice(writes, mismatch=True).frames(prefetch=core.num_threads):
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="xClean parameter sweep")
+    parser.add_argument("source", help="VapourSynth script, output 0 is the source clip")
+    parser.add_argument("settings", nargs="*", help="name=value or name=value1,value2,... to sweep")
+    parser.add_argument("--frames", nargs="+", type=int, required=True)
+    parser.add_argument("--stack", help="Write a comparison stack per frame to this PNG, the frame number is appended")
+    parser.add_argument("--output-dir", help="Write one PNG per configuration and frame to this directory")
+    parser.add_argument("--columns", type=int, default=0)
+    args = parser.parse_args()
+    if not args.stack and not args.output_dir:
+        parser.error("one of --stack or --output-dir is required")
+
+    grid, kwargs = {}, {}
+    for s in args.settings:
+        name, value = s.split("=", 1)
+        values = [ParseValue(v) for v in value.split(",")]
+        if len(values) > 1:
+            grid[name] = values
+        else:
+            kwargs[name] = values[0]
+
+    clip = LoadSource(args.source)
+    sweep = Sweep(clip, grid, **kwargs)
+    images = []
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        images += [(os.path.join(args.output_dir, f"{i:03}_" + FileName(config)), node) for i, (config, node) in enumerate(sweep)]
+    if args.stack:
+        images += [(os.path.splitext(args.stack)[0], ComparisonStack(clip, sweep, args.columns))]
+    WriteImages(images, args.frames)